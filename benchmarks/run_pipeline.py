@@ -0,0 +1,273 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Measures the overhead semgrep-search adds around semgrep when running `sgs run`, by the phases of the run.
+
+semgrep is replaced by a stub that writes a configurable amount of stdout/stderr at a configurable rate and
+creates synthetic JSON/SARIF/text outputs, so the benchmark runs offline and only measures semgrep-search itself.
+
+    PYTHONPATH=. python benchmarks/run_pipeline.py --stdout-mb 50 --stderr-mb 5 --findings 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, TextIO
+
+from rich import box
+from rich.console import Console
+from rich.table import Table
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from semgrep_search.main import parse_args as parse_sgs_args
+from semgrep_search.metrics import metrics
+from semgrep_search.run import do_run
+from semgrep_search.runconfig import RunConfig
+
+STUB = r'''#!{python}
+import json, os, sys, time
+
+start = time.perf_counter()
+args = sys.argv[1:]
+if '--version' in args:
+    print('0.0.0-stub')
+    sys.exit(0)
+
+outputs = {{args[i]: args[i + 1] for i in range(len(args) - 1) if args[i].endswith('-output')}}
+config = os.environ['SGS_BENCH']
+settings = json.loads(config)
+
+
+def emit(stream, total, rate):
+    line_size = settings['line_size']
+    written = 0
+    began = time.perf_counter()
+    while written < total:
+        # Every line starts with the time it was written, to measure the forwarding latency
+        prefix = f'{{time.time_ns()}} '
+        stream.write(prefix + 'x' * max(0, line_size - len(prefix) - 1) + '\n')
+        written += line_size
+        if rate > 0:
+            ahead = written / rate - (time.perf_counter() - began)
+            if ahead > 0:
+                stream.flush()
+                time.sleep(ahead)
+    stream.flush()
+
+
+emit(sys.stderr, settings['stderr_bytes'], settings['rate'])
+emit(sys.stdout, settings['stdout_bytes'], settings['rate'])
+
+findings = settings['findings']
+results = ({{'check_id': f'tmp.bench.rule-{{i % settings["rules"]}}', 'path': f'src/file{{i}}.py',
+            'start': {{'line': 1, 'col': 1}}, 'end': {{'line': 1, 'col': 5}},
+            'extra': {{'message': 'finding', 'severity': ('ERROR', 'WARNING', 'INFO')[i % 3], 'lines': 'x = 1',
+                      'metadata': {{}}}}}} for i in range(findings))
+if '--json-output' in outputs:
+    with open(outputs['--json-output'], 'w') as stream:
+        stream.write('{{"results": [')
+        for i, result in enumerate(results):
+            stream.write((',' if i else '') + json.dumps(result))
+        stream.write('], "errors": [], "paths": {{"scanned": []}}}}')
+if '--sarif-output' in outputs:
+    with open(outputs['--sarif-output'], 'w') as stream:
+        stream.write('{{"version": "2.1.0", "runs": [{{"tool": {{"driver": {{"name": "stub", "rules": []}}}}, "results": [')
+        for i in range(findings):
+            stream.write((',' if i else '') + json.dumps({{
+                'ruleId': f'tmp.bench.rule-{{i % settings["rules"]}}', 'level': 'error', 'message': {{'text': 'x'}}}}))
+        stream.write(']}}]}}')
+if '--text-output' in outputs:
+    with open(outputs['--text-output'], 'w') as stream:
+        for i in range(findings):
+            stream.write(f'src/file{{i}}.py: bench.rule-{{i % settings["rules"]}}\n')
+
+with open(settings['report'], 'w') as stream:
+    json.dump({{'elapsed': time.perf_counter() - start}}, stream)
+'''
+
+
+class ForwardingSink:
+    """Replaces sys.stdout/sys.stderr while semgrep runs and records how long each line took to arrive"""
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.latencies: list[float] = []
+
+    def write(self, data: str) -> int:
+        now = time.time_ns()
+        self.bytes += len(data)
+        prefix = data.split(' ', 1)[0]
+        if prefix.isdigit():
+            self.latencies.append((now - int(prefix)) / 1e6)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+@contextmanager
+def redirect(stdout: TextIO, stderr: TextIO) -> Iterator[None]:
+    original = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = original
+
+
+def synthetic_rules(count: int) -> TinyDB:
+    db = TinyDB(storage=MemoryStorage)
+    db.table('rules').insert_multiple({
+        'id': f'bench.rule-{i}',
+        'languages': ['python'],
+        'severity': ('ERROR', 'WARNING', 'INFO')[i % 3],
+        'category': 'security',
+        'source': 'bench',
+        'content': f'id: bench.rule-{i}\nmessage: Benchmark rule {i}\nlanguages:\n- python\n'
+                   f'severity: ERROR\nmetadata:\n  category: security\n  cwe:\n  - "CWE-{i}: Test"\n'
+                   f'patterns:\n- pattern: dangerous_{i}($X)\n- pattern-not: dangerous_{i}("...")\n',
+    } for i in range(count))
+    db.table('repos').insert({'id': 'bench', 'name': 'bench', 'license': 'MIT', 'url': 'https://example.com'})
+    return db
+
+
+class Phases:
+    def __init__(self) -> None:
+        self.timings: dict[str, float] = {}
+
+    def add(self, name: str, timing: float) -> None:
+        self.timings[name] = self.timings.get(name, 0) + timing
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+def run_once(args: argparse.Namespace, workdir: Path, stub: Path, phases: Phases) -> dict:
+    report = workdir / 'report.json'
+    os.environ['SGS_BENCH'] = json.dumps({
+        'stdout_bytes': int(args.stdout_mb * 2 ** 20),
+        'stderr_bytes': int(args.stderr_mb * 2 ** 20),
+        'rate': args.rate_mb * 2 ** 20,
+        'line_size': args.line_size,
+        'findings': args.findings,
+        'rules': args.rules,
+        'report': str(report),
+    })
+    db = synthetic_rules(args.rules)
+
+    with phases.measure('argument parsing'):
+        argv = ['sgs', 'run', '-l', 'python', '--json', '--sarif', '--enrich', '-O', str(workdir / 'out'),
+                '--binary', str(stub), '--rules-format', args.rules_format, str(workdir)]
+        original, sys.argv = sys.argv, argv
+        try:
+            run = RunConfig.from_args(parse_sgs_args())
+        finally:
+            sys.argv = original
+
+    # The run itself, with the phases as timed by its pipeline
+    sink = ForwardingSink()
+    with phases.measure('total'), redirect(sink, sink):
+        asyncio.run(do_run(run, lambda: db))
+    durations = {labels['phase']: duration for labels, duration in metrics.samples('sgs_phase_duration_seconds')}
+    for name, duration in durations.items():
+        phases.add(name, duration)
+    # Everything the stub did not spend itself is spent on process setup and forwarding its output
+    stub_elapsed = json.loads(report.read_text())['elapsed']
+    phases.add('semgrep overhead', durations['semgrep'] - stub_elapsed)
+    return {'forwarded_bytes': sink.bytes, 'latencies': sink.latencies, 'stub_elapsed': stub_elapsed}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of sgs run around semgrep',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rules', type=int, default=1000, help='Number of synthetic rules')
+    parser.add_argument('--rules-format', choices=('yaml', 'json'), default='yaml', help='Format of the ruleset')
+    parser.add_argument('--stdout-mb', type=float, default=10, help='MB the stub writes to stdout')
+    parser.add_argument('--stderr-mb', type=float, default=1, help='MB the stub writes to stderr')
+    parser.add_argument('--rate-mb', type=float, default=0, help='MB/s the stub writes at (0 for unlimited)')
+    parser.add_argument('--line-size', type=int, default=120, help='Length of the lines written by the stub')
+    parser.add_argument('--findings', type=int, default=10000, help='Number of findings in the stub outputs')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs to average')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the results as JSON')
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    phases = Phases()
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-bench-') as tmp:
+        workdir = Path(tmp)
+        stub = workdir / 'semgrep'
+        stub.write_text(STUB.format(python=sys.executable))
+        stub.chmod(0o755)
+        for _ in range(args.repeat):
+            runs.append(run_once(args, workdir, stub, phases))
+
+    latencies = sorted(latency for run in runs for latency in run['latencies'])
+    forwarded = sum(run['forwarded_bytes'] for run in runs)
+    semgrep_time = phases.timings['semgrep']
+    summary = {
+        'phases': {name: timing / args.repeat for name, timing in phases.timings.items()},
+        'forwarding_throughput_mb_s': forwarded / 2 ** 20 / semgrep_time if semgrep_time else 0,
+        'forwarding_latency_ms': {
+            'p50': statistics.median(latencies) if latencies else 0,
+            'p99': latencies[int(len(latencies) * 0.99)] if latencies else 0,
+            'max': latencies[-1] if latencies else 0,
+        },
+        # ru_maxrss is reported in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stub_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    console = Console()
+    table = Table(title='Phases (average per run)', box=box.SIMPLE)
+    table.add_column('Phase', style='blue')
+    table.add_column('Time', style='green', justify='right')
+    for name, timing in summary['phases'].items():
+        table.add_row(name, f'{timing * 1000:.1f} ms')
+    console.print(table)
+    latency = summary['forwarding_latency_ms']
+    console.print(f'Forwarding throughput: {summary["forwarding_throughput_mb_s"]:.1f} MB/s')
+    console.print(f'Forwarding latency: p50 {latency["p50"]:.2f} ms, p99 {latency["p99"]:.2f} ms, '
+                  f'max {latency["max"]:.2f} ms')
+    console.print(f'Peak RSS: {summary["peak_rss_mb"]:.1f} MB (stub: {summary["stub_peak_rss_mb"]:.1f} MB)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import logging
+import shutil
+import sys
+from pathlib import Path
+from typing import Hashable, Iterable, TYPE_CHECKING
+
+from semgrep_search.cache import load_fragments
+from semgrep_search.facets import FACETS, apply_facets, load_index
+from semgrep_search.metrics import metrics
+from semgrep_search.quarantine import get_quarantine
+from semgrep_search.runconfig import RunConfig
+from semgrep_search.search import FilterConfig, build_query
+from semgrep_search.utils import atomic_write, get_commit, hash_rule, logger, measure_time, render_rule, write_ruleset
+
+if TYPE_CHECKING:
+    import argparse
+    from tinydb import TinyDB
+    from tinydb.table import Document
+
+# The attributes of a rule that the filters of a FilterConfig (apart from the rule ids and metadata) look at
+FILTERED_FIELDS = ('languages', 'category', 'severity', 'source')
+_MISSING = object()
+
+
+def parse_spec(spec: str) -> FilterConfig:
+    """
+    Parses either a run configuration string or a filter specification (e.g. languages=python;categories=security)
+    """
+    if '=' in spec or spec in ('all', 'include_empty'):
+        return FilterConfig.parse(spec)
+    return RunConfig.from_code(spec).filter_config
+
+
+def read_specs(lines: Iterable[str]) -> list[tuple[Path, FilterConfig]]:
+    specs = []
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        output, _, spec = line.partition(' ')
+        try:
+            specs.append((Path(output), parse_spec(spec.strip())))
+        except ValueError as e:
+            logger.error(f'Invalid specification in line {number}: {e}')
+            sys.exit(1)
+    return specs
+
+
+def _signature(rule: Document) -> Hashable:
+    def freeze(value: object) -> Hashable:
+        return tuple(value) if isinstance(value, list) else value
+    return tuple(freeze(rule.get(name, _MISSING)) for name in FILTERED_FIELDS)
+
+
+def select_rules(rules: list[Document], configs: list[FilterConfig]) -> list[list[Document]]:
+    """
+    Evaluates all configs at once. Rules with the same filtered attributes are grouped, so the queries only have to be
+    evaluated once per group instead of once per rule.
+    """
+    groups: dict[Hashable, list[Document]] = {}
+    for rule in rules:
+        groups.setdefault(_signature(rule), []).append(rule)
+    representatives = [(group[0], group) for group in groups.values()]
+    logger.debug(f'Grouped {len(rules)} rules into {len(groups)} groups')
+    # Selections keep the order of the database, like a regular search does
+    positions = {rule.doc_id: position for position, rule in enumerate(rules)}
+
+    # Identical configs (e.g. the same run configuration for many projects) are only evaluated once as well
+    selections: dict[str, list[Document]] = {}
+    results = []
+    for config in configs:
+        included_ids = config.included_ids
+        facet_ids = config.facet_ids
+        key = f'{config.describe()}|{",".join(sorted(config.excluded_ids or ()))}|' \
+              f'{",".join(sorted(included_ids)) if included_ids is not None else "*"}'
+        if key not in selections:
+            query = build_query(config)
+            excluded_ids = config.excluded_ids or set()
+            matched = [rule for representative, group in representatives if query(representative)
+                       for rule in group
+                       if rule['id'] not in excluded_ids and (included_ids is None or rule['id'] in included_ids)
+                       and (facet_ids is None or rule['id'] in facet_ids)]
+            selections[key] = sorted(matched, key=lambda rule: positions[rule.doc_id])
+        results.append(selections[key])
+    return results
+
+
+def batch(args: argparse.Namespace, db: TinyDB) -> None:
+    if args.specs == '-':
+        specs = read_specs(sys.stdin)
+    else:
+        with Path(args.specs).open('r', encoding='utf-8') as stream:
+            specs = read_specs(stream)
+    if not specs:
+        logger.info('No specifications found')
+        return
+
+    quarantined = get_quarantine(get_commit(db), shutil.which('semgrep'))
+    if quarantined:
+        logger.info(f'Excluding {len(quarantined)} quarantined rules')
+    index = load_index(db) if any(getattr(config, facet) is not None for _, config in specs for facet in FACETS) \
+        else None
+    for _, config in specs:
+        config.excluded_ids = (config.excluded_ids or set()) | quarantined
+        apply_facets(config, db, index)
+
+    rules = db.table('rules').all()
+    with measure_time(f'Evaluated {len(specs)} specifications in %s', logging.DEBUG):
+        selections = select_rules(rules, [config for _, config in specs])
+
+    formats = [args.format or ('json' if output.suffix == '.json' else 'yaml') for output, _ in specs]
+    # Every rule is rendered at most once per format, no matter how many rulesets it ends up in
+    rendered: dict[str, dict[int, str]] = {}
+    with metrics.timer('sgs_ruleset_serialization_seconds_total', 'Time spent serializing rulesets'):
+        for ruleset_format in set(formats):
+            fragments = load_fragments(ruleset_format)
+            distinct = {rule.doc_id: rule for selection, selection_format in zip(selections, formats)
+                        if selection_format == ruleset_format for rule in selection}
+            try:
+                rendered[ruleset_format] = {
+                    doc_id: fragments.get(hash_rule(rule)) or render_rule(rule, ruleset_format)
+                    for doc_id, rule in distinct.items()
+                }
+            except ValueError as e:
+                # Before any ruleset is written
+                logger.error(str(e))
+                sys.exit(1)
+            logger.debug(f'Rendered {len(distinct)} distinct rules as {ruleset_format}')
+
+        for (output, config), selection, ruleset_format in zip(specs, selections, formats):
+            with atomic_write(output) as stream:
+                write_ruleset(selection, stream, rendered[ruleset_format], ruleset_format, key=lambda rule: rule.doc_id)
+            metrics.gauge('sgs_rules_selected', len(selection), 'Number of rules matching a filter',
+                          filter=config.describe())
+            metrics.inc('sgs_ruleset_rules_total', 'Number of rules written to rulesets', len(selection))
+            logger.debug(f'Written {len(selection)} rules to {output}')
+
+    logger.info(f'Successfully written {len(specs)} rulesets with '
+                f'{len({rule.doc_id for selection in selections for rule in selection})} distinct rules')
@@ -0,0 +1,121 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Callable, Optional, TYPE_CHECKING
+
+from semgrep_search.const import CACHE_DIR
+from semgrep_search.metrics import metrics
+from semgrep_search.utils import atomic_write, get_cache_key, hash_rule, logger, render_rule
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+
+
+class DerivedCache:
+    """
+    Artifacts derived from a single version of the database, stored in a directory per database commit
+    """
+
+    def __init__(self, commit: Optional[str]) -> None:
+        self.directory = CACHE_DIR / commit if commit else None
+
+    @staticmethod
+    def for_db(db: TinyDB) -> 'DerivedCache':
+        return DerivedCache(get_cache_key(db))
+
+    def path(self, name: str) -> Optional[Path]:
+        return self.directory / name if self.directory is not None else None
+
+    def load(self, name: str) -> Optional[Any]:
+        file = self.path(name)
+        if file is None or not file.is_file():
+            metrics.cache(name, hit=False)
+            return None
+        try:
+            with file.open('r', encoding='utf-8') as stream:
+                data = json.load(stream)
+        except Exception as e:
+            logger.debug(f'Unable to load {file}: {e}')
+            metrics.cache(name, hit=False)
+            return None
+        metrics.cache(name, hit=True)
+        return data
+
+    def store(self, name: str, data: Any) -> None:
+        file = self.path(name)
+        if file is None:
+            return
+        with atomic_write(file) as stream:
+            json.dump(data, stream)
+
+    def get_or_compute(self, name: str, compute: Callable[[], Any]) -> Any:
+        data = self.load(name)
+        if data is None:
+            data = compute()
+            self.store(name, data)
+        return data
+
+    def ruleset(self, code: str, ruleset_format: str = 'yaml') -> Optional[Path]:
+        """The pre-generated ruleset of a run configuration"""
+        return self.path(f'rulesets/{code}.{ruleset_format}')
+
+
+def fragments_file(ruleset_format: str) -> Path:
+    return CACHE_DIR / f'fragments.{ruleset_format}.json'
+
+
+def load_fragments(ruleset_format: str = 'yaml') -> dict[str, str]:
+    """
+    Loads the pre-rendered rules. They are keyed by the hash of the rule, so they remain valid across database versions.
+    """
+    file = fragments_file(ruleset_format)
+    if not file.is_file():
+        return {}
+    try:
+        with file.open('r', encoding='utf-8') as stream:
+            return json.load(stream)
+    except Exception as e:
+        logger.debug(f'Unable to load {file}: {e}')
+        return {}
+
+
+def update_fragments(db: TinyDB, ruleset_format: str = 'yaml') -> tuple[int, int]:
+    """
+    Renders all rules of the database that have not been rendered yet and drops the ones no longer in the database.
+    Returns the number of rendered and total rules.
+    """
+    previous = load_fragments(ruleset_format)
+    fragments = {}
+    rendered = 0
+    for rule in db.table('rules'):
+        digest = hash_rule(rule)
+        fragment = previous.get(digest)
+        if fragment is None:
+            try:
+                fragment = render_rule(rule, ruleset_format)
+            except ValueError as e:
+                # Not cached, so only runs selecting the rule fail
+                logger.warning(str(e))
+                continue
+            rendered += 1
+        fragments[digest] = fragment
+    with atomic_write(fragments_file(ruleset_format)) as stream:
+        json.dump(fragments, stream)
+    return rendered, len(fragments)
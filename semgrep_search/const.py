@@ -36,8 +36,28 @@ def generate_aliases(languages: OrderedDict[str, list[str]]) -> dict[str, str]:
 DATA_DIR = Path.home() / '.cache' / 'semgrep-search'
 DB_FILENAME = 'db.json'
 DB_FILE = DATA_DIR / DB_FILENAME
+SNAPSHOT_DIR = DATA_DIR / 'snapshots'
+PREVIOUS_COMMIT_FILE = SNAPSHOT_DIR / 'previous'
+QUARANTINE_FILE = DATA_DIR / 'quarantine.json'
+CACHE_DIR = DATA_DIR / 'cache'
+LOCAL_DB_FILE = DATA_DIR / 'local.json'
+HISTORY_FILE = DATA_DIR / 'history.sqlite'
+MANIFEST_DIR = DATA_DIR / 'manifests'
 CATEGORIES = ('best-practice', 'correctness', 'maintainability', 'performance', 'portability', 'security')
 SEVERITIES = ('ERROR', 'INFO', 'WARNING')
+RULESET_FORMATS = ('yaml', 'json')
+# Maps the severities used by semgrep (both legacy and current) onto a single scale
+NORMALIZED_SEVERITIES = {
+    'CRITICAL': 'critical',
+    'ERROR': 'high',
+    'HIGH': 'high',
+    'WARNING': 'medium',
+    'MEDIUM': 'medium',
+    'INFO': 'low',
+    'LOW': 'low',
+    'INVENTORY': 'info',
+    'EXPERIMENT': 'info',
+}
 
 LANGUAGES = OrderedDict([
     ('Apex', ['apex']),
@@ -80,4 +100,45 @@ LANGUAGES = OrderedDict([
 
 LANGUAGE_ALIASES = generate_aliases(LANGUAGES)
 
+# Maps file extensions onto the languages of the rules matching them
+LANGUAGE_EXTENSIONS = {
+    '.cls': 'apex',
+    '.sh': 'bash', '.bash': 'bash',
+    '.c': 'c', '.h': 'c',
+    '.cairo': 'cairo',
+    '.clj': 'clojure', '.cljs': 'clojure', '.cljc': 'clojure', '.edn': 'clojure',
+    '.cc': 'cpp', '.cpp': 'cpp', '.cxx': 'cpp', '.hh': 'cpp', '.hpp': 'cpp', '.hxx': 'cpp',
+    '.cs': 'csharp',
+    '.dart': 'dart',
+    '.dockerfile': 'dockerfile',
+    '.ex': 'ex', '.exs': 'ex',
+    '.go': 'go',
+    '.htm': 'html', '.html': 'html',
+    '.java': 'java',
+    '.cjs': 'js', '.js': 'js', '.jsx': 'js', '.mjs': 'js',
+    '.json': 'json',
+    '.jsonnet': 'jsonnet', '.libsonnet': 'jsonnet',
+    '.jl': 'julia',
+    '.kt': 'kt', '.kts': 'kt',
+    '.lisp': 'lisp', '.lsp': 'lisp',
+    '.lua': 'lua',
+    '.ml': 'ocaml', '.mli': 'ocaml',
+    '.php': 'php',
+    '.py': 'python', '.pyi': 'python',
+    '.r': 'r',
+    '.rb': 'ruby',
+    '.rs': 'rust',
+    '.scala': 'scala',
+    '.scm': 'scheme', '.ss': 'scheme',
+    '.sol': 'solidity',
+    '.swift': 'swift',
+    '.hcl': 'tf', '.tf': 'tf',
+    '.ts': 'ts', '.tsx': 'ts',
+    '.yaml': 'yaml', '.yml': 'yaml',
+    '.xml': 'xml',
+}
+LANGUAGE_FILENAMES = {
+    'dockerfile': 'dockerfile',
+}
+
 
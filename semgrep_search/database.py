@@ -25,7 +25,9 @@ from oras.provider import Registry
 from tinydb import TinyDB
 
 from semgrep_search.const import DB_FILE, DB_FILENAME
-from semgrep_search.utils import logger, measure_time
+from semgrep_search.delta import set_previous_commit, store_snapshot
+from semgrep_search.ingest import apply_local_rules
+from semgrep_search.utils import get_commit, logger, measure_time
 
 if TYPE_CHECKING:
     import argparse
@@ -49,7 +51,7 @@ def load_local(args: argparse.Namespace) -> Optional[TinyDB]:
         return None
 
 
-def update_db(args: argparse.Namespace) -> Optional[TinyDB]:
+def update_db(args: argparse.Namespace, previous_commit: Optional[str] = None) -> Optional[TinyDB]:
     files = GhcrProvider().pull(target='hnzlmnn/semgrep-search-db:latest')
     for file in files:
         path = Path(file)
@@ -63,7 +65,14 @@ def update_db(args: argparse.Namespace) -> Optional[TinyDB]:
                 return None
             # Copy the database to the cache location
             shutil.copyfile(path, DB_FILE)
-            return load_local(args)
+            db = load_local(args)
+            if db is not None:
+                # The update replaced the whole database, including the ingested local rules
+                apply_local_rules(db)
+            if db is not None and previous_commit is not None and get_commit(db) != previous_commit:
+                # Remember the replaced version to be able to run only the rules that changed since
+                set_previous_commit(previous_commit)
+            return db
     logger.error('Could not find the database file in ')
     return None
 
@@ -73,7 +82,10 @@ def get_database(args: argparse.Namespace) -> Optional[TinyDB]:
     db = load_local(args)
 
     if (db is None or args.update) and args.database is None:
+        previous_commit = None
         if db is not None:
+            # Keep the rule hashes of the current version to be able to compute the changes of the update
+            previous_commit = store_snapshot(db)
             # Make sure we close the database before running update
             db.close()
 
@@ -81,7 +93,7 @@ def get_database(args: argparse.Namespace) -> Optional[TinyDB]:
 
         # Try to update
         with measure_time('Updated database in %s', logging.DEBUG):
-            return update_db(args)
+            return update_db(args, previous_commit)
 
     # No update should occur
     return db
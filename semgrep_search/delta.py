@@ -0,0 +1,189 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, TYPE_CHECKING
+
+from semgrep_search.const import SNAPSHOT_DIR, PREVIOUS_COMMIT_FILE
+from semgrep_search.metrics import metrics
+from semgrep_search.results import DROP, JSON_RESULTS, SARIF_RESULTS, SARIF_RULES, RuleIdResolver, rewrite_file
+from semgrep_search.utils import atomic_write, get_commit, hash_rule, logger
+
+if TYPE_CHECKING:
+    from semgrep_search.results import Transforms
+    from tinydb import TinyDB
+
+
+def snapshot_file(commit: str) -> Path:
+    return SNAPSHOT_DIR / f'{commit}.json'
+
+
+def store_snapshot(db: TinyDB) -> Optional[str]:
+    """
+    Stores the content hashes of all rules in the database (unless already stored) and returns the database commit
+    """
+    commit = get_commit(db)
+    if commit is None:
+        logger.debug('Database has no commit, not storing a snapshot of its rules')
+        return None
+
+    file = snapshot_file(commit)
+    metrics.cache('snapshot', hit=file.exists())
+    if not file.exists():
+        with atomic_write(file) as stream:
+            json.dump({rule['id']: hash_rule(rule) for rule in db.table('rules')}, stream)
+    return commit
+
+
+def load_snapshot(commit: str) -> Optional[dict[str, str]]:
+    file = snapshot_file(commit)
+    if not file.is_file():
+        return None
+    with file.open('r', encoding='utf-8') as stream:
+        return json.load(stream)
+
+
+def set_previous_commit(commit: str) -> None:
+    with atomic_write(PREVIOUS_COMMIT_FILE) as stream:
+        stream.write(commit)
+
+
+def get_previous_commit() -> Optional[str]:
+    if not PREVIOUS_COMMIT_FILE.is_file():
+        return None
+    return PREVIOUS_COMMIT_FILE.read_text(encoding='utf-8').strip() or None
+
+
+@dataclass
+class RuleDelta:
+    base: str
+    added: set[str]
+    modified: set[str]
+    removed: set[str]
+
+    @property
+    def changed(self) -> set[str]:
+        """Rules that have to be run"""
+        return self.added | self.modified
+
+    @property
+    def stale(self) -> set[str]:
+        """
+        Rules whose previous findings are replaced or no longer valid. Rules added since the base are included, as the
+        previous outputs already contain their findings if an earlier run used the same base.
+        """
+        return self.added | self.modified | self.removed
+
+    @staticmethod
+    def compute(db: TinyDB, base: Optional[str]) -> 'RuleDelta':
+        base = base or get_previous_commit()
+        if base is None:
+            raise ValueError('No previous database version is known, specify the commit to compare against')
+        previous = load_snapshot(base)
+        if previous is None:
+            raise ValueError(f'No snapshot of the rules of database version {base} exists')
+
+        current = {rule['id']: hash_rule(rule) for rule in db.table('rules')}
+        return RuleDelta(
+            base=base,
+            added={rule_id for rule_id in current if rule_id not in previous},
+            modified={rule_id for rule_id, digest in current.items()
+                      if rule_id in previous and previous[rule_id] != digest},
+            removed={rule_id for rule_id in previous if rule_id not in current},
+        )
+
+    def __str__(self) -> str:
+        return (f'{len(self.added)} added, {len(self.modified)} modified and {len(self.removed)} removed rules '
+                f'since {self.base}')
+
+
+class DeltaMerger:
+    """
+    Keeps the findings of the previous run and merges them with the findings of a run of only the changed rules
+    """
+
+    def __init__(self, outputs: dict[str, Path], delta: RuleDelta, known_ids: set[str]) -> None:
+        self._outputs = {fmt: file for fmt, file in outputs.items() if fmt in ('json', 'sarif')}
+        self._stale = delta.stale
+        self._resolver = RuleIdResolver(known_ids | delta.removed)
+        self._previous: dict[str, Path] = {}
+        if 'text' in outputs:
+            logger.warning('Text output can not be merged, it will only contain findings of the changed rules')
+
+    @staticmethod
+    def _stash_file(file: Path) -> Path:
+        return file.with_name(f'{file.name}.previous')
+
+    def stash(self) -> None:
+        """Moves the previous outputs out of the way, before semgrep overwrites them"""
+        for fmt, file in self._outputs.items():
+            if not file.is_file():
+                logger.warning(f'No previous findings found at {file}, it will only contain findings of the '
+                               f'changed rules')
+                continue
+            stash = self._stash_file(file)
+            file.replace(stash)
+            self._previous[fmt] = stash
+
+    def restore(self) -> None:
+        for fmt, stash in self._previous.items():
+            stash.replace(self._outputs[fmt])
+        self._previous = {}
+
+    def _drop_stale(self, key: str) -> Callable[[dict], object]:
+        def transform(item: dict) -> object:
+            if self._resolver.resolve(item.get(key)) in self._stale:
+                return DROP
+            return item
+        return transform
+
+    def _transforms(self, fmt: str) -> Transforms:
+        if fmt == 'json':
+            return {JSON_RESULTS: self._drop_stale('check_id')}
+        return {SARIF_RESULTS: self._drop_stale('ruleId'), SARIF_RULES: self._drop_stale('id')}
+
+    def drop_stale(self) -> None:
+        """Removes the findings of the changed and removed rules from the previous outputs, if no rule has to run"""
+        for fmt, file in self._outputs.items():
+            if file.is_file():
+                rewrite_file(file, self._transforms(fmt))
+
+    def merge(self) -> None:
+        for fmt, stash in self._previous.items():
+            file = self._outputs[fmt]
+            if not file.is_file():
+                logger.warning(f'semgrep did not create {file}, keeping the previous findings')
+                stash.replace(file)
+                continue
+
+            with file.open('r', encoding='utf-8') as stream:
+                current = json.load(stream)
+
+            if fmt == 'json':
+                rewrite_file(stash, self._transforms(fmt), {JSON_RESULTS: lambda: current.get('results', [])},
+                             destination=file)
+            else:
+                run = (current.get('runs') or [{}])[0]
+                rewrite_file(stash, self._transforms(fmt), {
+                    SARIF_RESULTS: lambda run=run: run.get('results', []),
+                    SARIF_RULES: lambda run=run: run.get('tool', {}).get('driver', {}).get('rules', []),
+                }, destination=file)
+            stash.unlink()
+        self._previous = {}
@@ -0,0 +1,462 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Splits a scan into jobs that workers on other machines pull from a queue.
+
+The coordinator (run --distribute) publishes one job per combination of path shard and rule shard, requeues jobs
+whose worker stopped renewing its lease and merges the outputs of all jobs once they completed.
+Workers (the worker command) claim jobs, run semgrep and publish the outputs.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterator, Mapping, Optional, Union, TYPE_CHECKING
+
+from semgrep_search.metrics import metrics
+from semgrep_search.results import merge_outputs
+from semgrep_search.runconfig import RunConfig
+from semgrep_search.semgrep import find_semgrep, run_semgrep
+from semgrep_search.utils import atomic_write, logger, write_ruleset
+
+if TYPE_CHECKING:
+    import argparse
+    from semgrep_search.sharding import Shard
+
+# Jobs whose worker died this many times are given up
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.5
+
+
+@dataclass
+class Job:
+    id: str
+    # The ruleset within the queue
+    rules: str
+    # Paths relative to the target, all of it if empty
+    paths: list[str] = field(default_factory=list)
+    attempts: int = 0
+
+
+@dataclass
+class Session:
+    id: str
+    target: str
+    features: list[str]
+    jobs: int
+    # Seconds after which the job of a worker that did not renew its lease is retried
+    lease: float
+
+
+class JobQueue(ABC):
+    """
+    Where the coordinator publishes jobs and workers pick them up. A worker holds a lease on the job it runs,
+    which expires unless the worker renews it.
+    """
+
+    @abstractmethod
+    def open_session(self, session: Session, rulesets: Mapping[str, Path], jobs: list[Job]) -> None:
+        """
+        Replaces the previous session with a new one and publishes its rulesets and jobs.
+        Raises a ValueError if the previous session is still open.
+        """
+
+    @abstractmethod
+    def close_session(self) -> None:
+        """Tells the workers that no more jobs will be published"""
+
+    @abstractmethod
+    def session(self) -> Optional[Session]:
+        """The current session, if it is still open"""
+
+    @abstractmethod
+    def ruleset(self, name: str) -> Path:
+        """A local path of a ruleset of the current session"""
+
+    @abstractmethod
+    def claim(self, worker: str) -> Optional[Job]:
+        """Leases the next pending job to the worker"""
+
+    @abstractmethod
+    def workspace(self, job: Job, worker: str) -> Path:
+        """A directory for the outputs of a job, to be passed to complete"""
+
+    @abstractmethod
+    def renew(self, job: Job) -> bool:
+        """Renews the lease on the job, returns False if the lease was lost"""
+
+    @abstractmethod
+    def complete(self, job: Job, outputs: Path, rc: int) -> bool:
+        """Publishes the outputs of a job, returns False if another worker completed the job first"""
+
+    @abstractmethod
+    def requeue_expired(self, lease: float) -> tuple[list[Job], list[Job]]:
+        """Makes jobs with expired leases available again. Returns the requeued and the given up jobs."""
+
+    @abstractmethod
+    def results(self, session: Session) -> dict[str, tuple[int, Path]]:
+        """The exit codes and output directories of the completed jobs of the session"""
+
+    @abstractmethod
+    def failed(self, session: Session) -> list[str]:
+        """The ids of the jobs of the session that were given up"""
+
+
+class DirectoryQueue(JobQueue):
+    """
+    Queue within a directory shared by all machines, e.g. on NFS. Jobs are moved between the directories pending,
+    leased, done and failed by renaming them, which is atomic, so every job is only claimed by a single worker.
+    These directories are removed whenever a new session is opened.
+
+    Workers renew their lease by touching the leased job. The coordinator only notices whether the modification time
+    changed and measures the age of the lease by its own clock, so clocks of the workers (or of the file server)
+    that are ahead or behind do not matter.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._session_file = root / 'session.json'
+        self._closed = root / 'closed'
+        self._pending = root / 'pending'
+        self._leased = root / 'leased'
+        self._done = root / 'done'
+        self._failed = root / 'failed'
+        self._rules = root / 'rules'
+        self._tmp = root / 'tmp'
+        # The last heartbeat seen of each leased job and when it was seen, by the clock of the coordinator
+        self._heartbeats: dict[str, tuple[int, float]] = {}
+
+    def _directories(self) -> Iterator[Path]:
+        yield from (self._pending, self._leased, self._done, self._failed, self._rules, self._tmp)
+
+    def open_session(self, session: Session, rulesets: Mapping[str, Path], jobs: list[Job]) -> None:
+        active = self.session()
+        if active is not None:
+            raise ValueError(f'Session {active.id} of {self.root} is still open. If its coordinator is no longer '
+                             f'running, close it by creating {self._closed}')
+        self._session_file.unlink(missing_ok=True)
+        self._heartbeats = {}
+        for directory in self._directories():
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True)
+        for name, ruleset in rulesets.items():
+            shutil.copyfile(ruleset, self._rules / name)
+        for job in jobs:
+            self._write(self._pending / f'{job.id}.json', job)
+        self._closed.unlink(missing_ok=True)
+        # Workers only start claiming jobs once the session exists
+        with atomic_write(self._session_file) as stream:
+            json.dump(asdict(session), stream)
+
+    def close_session(self) -> None:
+        self._closed.touch()
+
+    def session(self) -> Optional[Session]:
+        if self._closed.exists():
+            return None
+        try:
+            with self._session_file.open('r', encoding='utf-8') as stream:
+                return Session(**json.load(stream))
+        except (OSError, ValueError):
+            return None
+
+    def ruleset(self, name: str) -> Path:
+        return self._rules / name
+
+    @staticmethod
+    def _write(path: Path, job: Job) -> None:
+        with atomic_write(path) as stream:
+            json.dump(asdict(job), stream)
+
+    @staticmethod
+    def _read(path: Path) -> Optional[Job]:
+        try:
+            with path.open('r', encoding='utf-8') as stream:
+                return Job(**json.load(stream))
+        except (OSError, ValueError):
+            return None
+
+    def claim(self, worker: str) -> Optional[Job]:
+        for pending in sorted(self._pending.glob('*.json')):
+            leased = self._leased / pending.name
+            try:
+                # The lease starts now, not when the job was published
+                os.utime(pending)
+                pending.rename(leased)
+            except FileNotFoundError:
+                # Another worker was faster
+                continue
+            job = self._read(leased)
+            if job is not None:
+                logger.debug(f'{worker} claimed job {job.id}')
+                return job
+        return None
+
+    def renew(self, job: Job) -> bool:
+        try:
+            os.utime(self._leased / f'{job.id}.json')
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, job: Job, outputs: Path, rc: int) -> bool:
+        (outputs / 'rc').write_text(str(rc), encoding='utf-8')
+        try:
+            outputs.rename(self._done / job.id)
+        except OSError:
+            shutil.rmtree(outputs, ignore_errors=True)
+            return False
+        (self._leased / f'{job.id}.json').unlink(missing_ok=True)
+        (self._pending / f'{job.id}.json').unlink(missing_ok=True)
+        # The job may have been given up on while its worker was still running it
+        failed = self._failed / f'{job.id}.json'
+        if failed.exists():
+            logger.info(f'Job {job.id} completed after it was given up on')
+            failed.unlink(missing_ok=True)
+        return True
+
+    def workspace(self, job: Job, worker: str) -> Path:
+        # On the same file system as the queue, so the outputs can be published by renaming the directory
+        directory = self._tmp / f'{job.id}.{worker}.{uuid.uuid4().hex[:8]}'
+        directory.mkdir(parents=True)
+        return directory
+
+    def requeue_expired(self, lease: float) -> tuple[list[Job], list[Job]]:
+        requeued = []
+        given_up = []
+        now = time.monotonic()
+        heartbeats = {}
+        for leased in self._leased.glob('*.json'):
+            try:
+                heartbeat = leased.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen = self._heartbeats.get(leased.name)
+            heartbeats[leased.name] = seen if seen is not None and seen[0] == heartbeat else (heartbeat, now)
+            if now - heartbeats[leased.name][1] <= lease:
+                continue
+            job = self._read(leased)
+            if job is None or (self._done / job.id).exists():
+                continue
+            del heartbeats[leased.name]
+            job.attempts += 1
+            # Written next to the lease first, so the job is never lost
+            retry = self._leased / f'{job.id}.retry'
+            self._write(retry, job)
+            retry.rename(self._pending / leased.name if job.attempts < MAX_ATTEMPTS else self._failed / leased.name)
+            leased.unlink(missing_ok=True)
+            (requeued if job.attempts < MAX_ATTEMPTS else given_up).append(job)
+        # Jobs no longer leased are forgotten
+        self._heartbeats = heartbeats
+        return requeued, given_up
+
+    def results(self, session: Session) -> dict[str, tuple[int, Path]]:
+        results = {}
+        for directory in self._done.iterdir():
+            if directory.name.startswith(f'{session.id}-'):
+                try:
+                    rc = int((directory / 'rc').read_text(encoding='utf-8'))
+                except (OSError, ValueError):
+                    rc = 2
+                results[directory.name] = (rc, directory)
+        return results
+
+    def failed(self, session: Session) -> list[str]:
+        return sorted(file.stem for file in self._failed.glob(f'{session.id}-*.json'))
+
+
+def open_queue(location: str) -> JobQueue:
+    """
+    Opens the queue at location. Only shared directories are supported so far (a path or a file:// URL).
+    """
+    if location.startswith('file://'):
+        location = location[len('file://'):]
+    elif '://' in location:
+        raise ValueError(f'Unsupported queue {location}')
+    return DirectoryQueue(Path(location).expanduser().absolute())
+
+
+def split_rules(rules: list[dict], count: int) -> list[list[dict]]:
+    # Rules of the same language end up in different shards, as they tend to have similar costs
+    shards = [rules[i::count] for i in range(count)]
+    return [shard for shard in shards if shard]
+
+
+def plan_jobs(session: str, rulesets: list[str], shards: Optional[list[Shard]]) -> list[Job]:
+    path_lists = [shard.paths for shard in shards] if shards else [[]]
+    jobs = []
+    for ruleset in rulesets:
+        for paths in path_lists:
+            jobs.append(Job(f'{session}-{len(jobs):04d}', ruleset, paths))
+    return jobs
+
+
+async def coordinate(run: RunConfig, rules: Optional[list[dict]], shards: Optional[list[Shard]],
+                     fragments: Optional[Mapping[str, str]] = None) -> int:
+    """
+    Publishes the scan as jobs and waits until workers completed all of them, then merges their outputs.
+    rules are only needed to split the ruleset into multiple rule shards.
+    """
+    try:
+        queue = open_queue(run.distribute)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    session = Session(uuid.uuid4().hex[:12], str(run.target.absolute()), run.features, 0, run.lease)
+    outputs = run.output_files()
+
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-jobs-') as tmp:
+        rulesets: dict[str, Path] = {}
+        if run.rule_shards > 1 and rules is not None:
+            for i, shard in enumerate(split_rules(rules, run.rule_shards)):
+                name = f'rules-{i}.{run.rules_format}'
+                rulesets[name] = Path(tmp) / name
+                with rulesets[name].open('w', encoding='utf-8') as stream:
+                    write_ruleset(shard, stream, fragments, run.rules_format)
+        else:
+            # semgrep picks the parser by the extension of the ruleset
+            rulesets[f'rules{run.rules_file.suffix}'] = run.rules_file
+
+        jobs = plan_jobs(session.id, list(rulesets), shards)
+        session.jobs = len(jobs)
+        try:
+            queue.open_session(session, rulesets, jobs)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+    logger.info(f'Published {len(jobs)} jobs ({len(rulesets)} rule shards, {len(shards or [None])} path shards) '
+                f'to {run.distribute}')
+
+    try:
+        with metrics.timer('sgs_semgrep_duration_seconds_total', 'Wall time spent running semgrep'):
+            results = await wait_for_jobs(queue, session)
+    finally:
+        queue.close_session()
+
+    failed = [job_id for job_id in queue.failed(session) if job_id not in results]
+    if failed:
+        logger.error(f'{len(failed)} jobs failed after {MAX_ATTEMPTS} attempts, their findings are missing')
+
+    ordered = [results[job.id] for job in jobs if job.id in results]
+    for output_format, destination in outputs.items():
+        files = [directory / f'job{destination.suffix}' for _, directory in ordered]
+        merge_outputs(output_format, [file for file in files if file.is_file()], destination,
+                      distinct_rules=len(rulesets) > 1)
+    crashed = [job.id for job in jobs if job.id in results and results[job.id][0] < 0]
+    if crashed:
+        logger.error(f'semgrep was killed while running the jobs {", ".join(crashed)}, their findings are missing')
+    rcs = [rc if rc >= 0 else 2 for rc, _ in ordered]
+    metrics.gauge('sgs_jobs', len(jobs), 'Number of jobs of the last distributed run', state='published')
+    metrics.gauge('sgs_jobs', len(failed), 'Number of jobs of the last distributed run', state='failed')
+    return max(rcs + ([2] if failed else []), default=0)
+
+
+async def wait_for_jobs(queue: JobQueue, session: Session) -> dict[str, tuple[int, Path]]:
+    reported = 0
+    while True:
+        requeued, given_up = queue.requeue_expired(session.lease)
+        for job in requeued:
+            logger.warning(f'The worker of job {job.id} stopped renewing its lease, retrying the job '
+                           f'(attempt {job.attempts + 1} of {MAX_ATTEMPTS})')
+        for job in given_up:
+            logger.error(f'Giving up on job {job.id} after {job.attempts} attempts')
+        metrics.inc('sgs_jobs_retried_total', 'Number of jobs retried after their worker died', len(requeued))
+
+        results = queue.results(session)
+        # A job given up on can still be completed by its worker, it is only counted once
+        finished = len(results.keys() | set(queue.failed(session)))
+        if finished != reported:
+            logger.info(f'{finished} of {session.jobs} jobs finished')
+            reported = finished
+        if finished >= session.jobs:
+            return results
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def run_job(queue: JobQueue, job: Job, session: Session, worker: str, binary: Union[Path, str],
+                  target: Path) -> None:
+    run = RunConfig.from_rules_file(queue.ruleset(job.rules), session.features)
+    run.binary = binary
+    run.target = target
+    workspace = queue.workspace(job, worker)
+
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(session.lease / 3)
+            if not queue.renew(job):
+                logger.warning(f'Lost the lease on job {job.id}, another worker may run it as well')
+                return
+
+    renewal = asyncio.create_task(heartbeat())
+    try:
+        rc = await run_semgrep(run, targets=job.paths or None, output=workspace / 'job')
+    finally:
+        renewal.cancel()
+    if queue.complete(job, workspace, rc):
+        logger.info(f'Completed job {job.id} with exit code {rc}')
+    else:
+        logger.warning(f'Job {job.id} was already completed by another worker, discarding the outputs')
+
+
+async def work(queue: JobQueue, worker: str, binary: Union[Path, str], target: Optional[Path], wait: bool) -> int:
+    """
+    Runs jobs until the session is closed (or, with wait, forever). Returns the number of completed jobs.
+    """
+    completed = 0
+    announced = None
+    while True:
+        session = queue.session()
+        if session is None:
+            if not wait and announced is not None:
+                return completed
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        if session.id != announced:
+            logger.info(f'Working on session {session.id} ({session.jobs} jobs)')
+            announced = session.id
+
+        job = queue.claim(worker)
+        if job is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        await run_job(queue, job, session, worker, binary, target or Path(session.target))
+        completed += 1
+
+
+def worker(args: argparse.Namespace) -> int:
+    try:
+        queue = open_queue(args.queue)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    binary = find_semgrep(args.binary)
+    worker_id = args.id or f'{socket.gethostname()}-{os.getpid()}'
+    target = Path(args.target).absolute() if args.target else None
+    completed = asyncio.run(work(queue, worker_id, binary, target, args.wait))
+    logger.info(f'{worker_id} completed {completed} jobs')
+    return 0
@@ -0,0 +1,140 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import logging
+import re
+from typing import Any, Iterable, Optional, TYPE_CHECKING
+
+from yaml import load as load_yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from semgrep_search.cache import DerivedCache
+from semgrep_search.utils import logger, measure_time
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+    from semgrep_search.search import FilterConfig
+
+# The filters of a FilterConfig selecting rules by their metadata and the metadata keys they look at
+FACETS = {
+    'cwes': 'cwe',
+    'owasp': 'owasp',
+    'confidence': 'confidence',
+    'likelihood': 'likelihood',
+    'impact': 'impact',
+}
+LEVELS = ('LOW', 'MEDIUM', 'HIGH')
+
+_CWE = re.compile(r'^\s*(?:CWE-)?(\d+)', re.IGNORECASE)
+_OWASP = re.compile(r'^\s*A(\d{1,2}):(\d{4})', re.IGNORECASE)
+
+
+def normalize_cwe(value: str) -> Optional[str]:
+    """CWE-89: Improper Neutralization ... becomes CWE-89"""
+    match = _CWE.match(value)
+    return f'CWE-{int(match.group(1))}' if match else None
+
+
+def normalize_owasp(value: str) -> Optional[str]:
+    """A3:2017 - Sensitive Data Exposure becomes A03:2017"""
+    match = _OWASP.match(value)
+    return f'A{int(match.group(1)):02d}:{match.group(2)}' if match else None
+
+
+def normalize_level(value: str) -> Optional[str]:
+    value = value.strip().upper()
+    return value if value in LEVELS else None
+
+
+NORMALIZERS = {
+    'cwes': normalize_cwe,
+    'owasp': normalize_owasp,
+    'confidence': normalize_level,
+    'likelihood': normalize_level,
+    'impact': normalize_level,
+}
+
+
+def normalize_values(facet: str, values: Iterable[str]) -> set[str]:
+    """
+    Normalizes the values of a filter, values that cannot be normalized are kept as is (and will not match any rule)
+    """
+    return {NORMALIZERS[facet](value) or value for value in values}
+
+
+def extract_facets(rule: dict) -> dict[str, list[str]]:
+    try:
+        data = load_yaml(rule['content'], Loader=SafeLoader)
+    except Exception as e:
+        logger.debug(f'Unable to parse rule {rule.get("id")}: {e}')
+        return {}
+    metadata = data.get('metadata') if isinstance(data, dict) else None
+    if not isinstance(metadata, dict):
+        return {}
+
+    facets = {}
+    for facet, key in FACETS.items():
+        raw: Any = metadata.get(key)
+        if raw is None:
+            continue
+        if not isinstance(raw, list):
+            raw = [raw]
+        values = {NORMALIZERS[facet](str(value)) for value in raw}
+        values.discard(None)
+        if values:
+            facets[facet] = sorted(values)
+    return facets
+
+
+def compute_index(db: TinyDB) -> dict[str, dict[str, list[str]]]:
+    """
+    Maps every value of every facet to the ids of the rules having it
+    """
+    index: dict[str, dict[str, set[str]]] = {facet: {} for facet in FACETS}
+    with measure_time('Extracted the metadata of all rules in %s', logging.DEBUG):
+        for rule in db.table('rules'):
+            for facet, values in extract_facets(rule).items():
+                for value in values:
+                    index[facet].setdefault(value, set()).add(rule['id'])
+    return {facet: {value: sorted(ids) for value, ids in values.items()} for facet, values in index.items()}
+
+
+def load_index(db: TinyDB) -> dict[str, dict[str, list[str]]]:
+    """
+    The metadata is only extracted once per database version, as it requires parsing every rule
+    """
+    return DerivedCache.for_db(db).get_or_compute('facets.json', lambda: compute_index(db))
+
+
+def apply_facets(config: FilterConfig, db: TinyDB, index: Optional[dict[str, dict[str, list[str]]]] = None) -> None:
+    """
+    Resolves the metadata filters of the config to the ids of the rules matching all of them
+    """
+    facets = {facet: getattr(config, facet) for facet in FACETS if getattr(config, facet) is not None}
+    if not facets:
+        return
+    index = index if index is not None else load_index(db)
+    selected: Optional[set[str]] = None
+    for facet, values in facets.items():
+        ids = {rule_id for value in values for rule_id in index.get(facet, {}).get(value, [])}
+        selected = ids if selected is None else selected & ids
+    config.facet_ids = selected
@@ -0,0 +1,304 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+History of the findings of all runs, stored in SQLite.
+
+Every finding is identified by a fingerprint of its rule, its path and its normalized code snippet, so it is recognized
+again when lines are added above it. A finding is stored once, with the run it (re-)appeared in, the last run it was
+seen in and the run that fixed it. A finding that was not found again is only fixed if its rule ran, so narrowing the
+rules of a run does not fix the findings of all other rules.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Collection, Iterator, Optional, TYPE_CHECKING
+
+from rich import box
+from rich.console import Console
+from rich.table import Table
+from yaml import YAMLError, load as load_yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from semgrep_search.const import HISTORY_FILE
+from semgrep_search.results import DROP, JSON_RESULTS, SARIF_RESULTS, RuleIdResolver, rewrite_file, scan_file
+from semgrep_search.utils import get_commit, logger
+
+if TYPE_CHECKING:
+    import argparse
+    from tinydb import TinyDB
+    from semgrep_search.runconfig import RunConfig
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    started REAL NOT NULL,
+    database TEXT,
+    findings INTEGER NOT NULL DEFAULT 0,
+    new INTEGER NOT NULL DEFAULT 0,
+    fixed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_by_target ON runs (target, started);
+
+CREATE TABLE IF NOT EXISTS findings (
+    target TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    path TEXT NOT NULL,
+    line INTEGER,
+    introduced_run INTEGER NOT NULL,
+    last_run INTEGER NOT NULL,
+    fixed_run INTEGER,
+    PRIMARY KEY (target, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS findings_by_rule ON findings (target, rule);
+CREATE INDEX IF NOT EXISTS findings_by_introduced_run ON findings (target, introduced_run);
+CREATE INDEX IF NOT EXISTS findings_by_last_run ON findings (target, last_run);
+CREATE INDEX IF NOT EXISTS findings_by_fixed_run ON findings (target, fixed_run);
+'''
+
+# Shown instead of the code by semgrep when not logged in
+HIDDEN_SNIPPET = 'requires login'
+
+
+def connect() -> sqlite3.Connection:
+    HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(HISTORY_FILE)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Fingerprinter:
+    """
+    Computes the fingerprints of the findings of a single run, for JSON and SARIF results alike
+    """
+
+    def __init__(self, target: Path, resolver: RuleIdResolver) -> None:
+        self._target = target if target.is_dir() else target.parent
+        self._resolver = resolver
+        self._lines: dict[str, list[str]] = {}
+        self._occurrences: dict[str, int] = {}
+
+    def _read(self, path: str, start: Optional[int], end: Optional[int]) -> str:
+        if path not in self._lines:
+            try:
+                self._lines[path] = (self._target / path).read_text(encoding='utf-8', errors='replace').splitlines()
+            except OSError:
+                self._lines[path] = []
+        if start is None:
+            return ''
+        return '\n'.join(self._lines[path][start - 1:(end or start)])
+
+    def rule(self, check_id: str) -> str:
+        return self._resolver.resolve(check_id) or check_id
+
+    def fingerprint(self, rule: str, path: str, snippet: Optional[str], start: Optional[int],
+                    end: Optional[int]) -> str:
+        if not snippet or snippet.strip() == HIDDEN_SNIPPET:
+            snippet = self._read(path, start, end)
+        # Indentation and line breaks do not change a finding
+        normalized = ' '.join(snippet.split())
+        digest = hashlib.sha256('\0'.join((rule, path, normalized)).encode('utf-8')).hexdigest()
+        # The same snippet can be reported multiple times within a file, e.g. for duplicated code
+        occurrence = self._occurrences.get(digest, 0)
+        self._occurrences[digest] = occurrence + 1
+        return f'{digest}:{occurrence}'
+
+    def json_result(self, result: dict) -> tuple[str, str, str, Optional[int]]:
+        rule = self.rule(result.get('check_id', ''))
+        path = result.get('path', '')
+        start = result.get('start', {}).get('line')
+        snippet = result.get('extra', {}).get('lines')
+        return self.fingerprint(rule, path, snippet, start, result.get('end', {}).get('line')), rule, path, start
+
+    def sarif_result(self, result: dict) -> tuple[str, str, str, Optional[int]]:
+        rule = self.rule(result.get('ruleId', ''))
+        location = (result.get('locations') or [{}])[0].get('physicalLocation', {})
+        path = location.get('artifactLocation', {}).get('uri', '')
+        region = location.get('region', {})
+        start = region.get('startLine')
+        snippet = region.get('snippet', {}).get('text')
+        return self.fingerprint(rule, path, snippet, start, region.get('endLine')), rule, path, start
+
+
+def record_run(connection: sqlite3.Connection, target: str, database: Optional[str], json_output: Path,
+               fingerprinter: Fingerprinter, rules: Collection[str]) -> tuple[int, set[str]]:
+    """
+    Records the findings of the JSON output of a run of the given rules.
+    Returns the id of the run and the fingerprints of the new findings.
+    """
+    with connection:
+        run_id = connection.execute('INSERT INTO runs (target, started, database) VALUES (?, ?, ?)',
+                                    (target, time.time(), database)).lastrowid
+
+        new = set()
+        findings = 0
+
+        def record(result: dict) -> object:
+            nonlocal findings
+            fingerprint, rule, path, line = fingerprinter.json_result(result)
+            findings += 1
+            row = connection.execute('SELECT last_run, fixed_run FROM findings WHERE target = ? AND fingerprint = ?',
+                                     (target, fingerprint)).fetchone()
+            if row is None:
+                new.add(fingerprint)
+                connection.execute('INSERT INTO findings (target, fingerprint, rule, path, line, introduced_run, '
+                                   'last_run) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (target, fingerprint, rule, path, line, run_id, run_id))
+            elif row['fixed_run'] is not None and row['last_run'] != run_id:
+                # Fixed before, so it is new again
+                new.add(fingerprint)
+                connection.execute('UPDATE findings SET line = ?, introduced_run = ?, last_run = ?, fixed_run = NULL '
+                                   'WHERE target = ? AND fingerprint = ?', (line, run_id, run_id, target, fingerprint))
+            else:
+                connection.execute('UPDATE findings SET line = ?, last_run = ? WHERE target = ? AND fingerprint = ?',
+                                   (line, run_id, target, fingerprint))
+            return DROP
+
+        scan_file(json_output, {JSON_RESULTS: record})
+
+        # Every open finding of the rules that ran that was not found again has been fixed
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS ran_rules (rule TEXT PRIMARY KEY)')
+        connection.execute('DELETE FROM ran_rules')
+        connection.executemany('INSERT OR IGNORE INTO ran_rules VALUES (?)', ((rule,) for rule in rules))
+        fixed = connection.execute('UPDATE findings SET fixed_run = ? WHERE target = ? AND fixed_run IS NULL '
+                                   'AND last_run != ? AND rule IN (SELECT rule FROM ran_rules)',
+                                   (run_id, target, run_id)).rowcount
+        connection.execute('UPDATE runs SET findings = ?, new = ?, fixed = ? WHERE id = ?',
+                           (findings, len(new), fixed, run_id))
+    logger.info(f'Recorded {findings} findings in the history: {len(new)} new, {fixed} fixed')
+    return run_id, new
+
+
+def ruleset_ids(file: Path) -> set[str]:
+    """The ids of the rules within a ruleset file"""
+    with file.open('r', encoding='utf-8') as stream:
+        ruleset = json.load(stream) if file.suffix == '.json' else load_yaml(stream, Loader=SafeLoader)
+    return {rule['id'] for rule in (ruleset or {}).get('rules', []) if 'id' in rule}
+
+
+def write_new_only(outputs: dict[str, Path], new: set[str], make_fingerprinter: Any) -> None:
+    """
+    Removes all findings from the JSON and SARIF outputs that were already reported by the previous run
+    """
+    if 'text' in outputs:
+        logger.warning('Text outputs cannot be reduced to new findings, they contain all findings')
+
+    def keep(fingerprint: Any) -> Any:
+        def transform(result: dict) -> object:
+            return result if fingerprint(result)[0] in new else DROP
+        return transform
+
+    if 'json' in outputs and outputs['json'].is_file():
+        rewrite_file(outputs['json'], {JSON_RESULTS: keep(make_fingerprinter().json_result)})
+    if 'sarif' in outputs and outputs['sarif'].is_file():
+        rewrite_file(outputs['sarif'], {SARIF_RESULTS: keep(make_fingerprinter().sarif_result)})
+
+
+def track_findings(run: RunConfig, db: TinyDB, rules: Optional[Collection[str]] = None) -> None:
+    """
+    Records the findings of a complete run of the given rules (by default the rules of the ruleset file of the run)
+    """
+    outputs = run.output_files()
+    if 'json' not in outputs or not outputs['json'].is_file():
+        logger.warning('Unable to record the findings, semgrep did not create the JSON output')
+        return
+
+    if rules is None:
+        try:
+            rules = ruleset_ids(run.rules_file)
+        except (OSError, ValueError, YAMLError) as e:
+            logger.warning(f'Unable to record the findings, the rules of {run.rules_file} are unknown: {e}')
+            return
+    # Rules of a custom ruleset are not within the database, but still have to be resolved
+    resolver = RuleIdResolver({rule['id'] for rule in db.table('rules')} | set(rules))
+    target = run.target.resolve()
+
+    def make_fingerprinter() -> Fingerprinter:
+        return Fingerprinter(target, resolver)
+
+    with closing(connect()) as connection:
+        _, new = record_run(connection, str(target), get_commit(db), outputs['json'], make_fingerprinter(), rules)
+    if run.new_only:
+        write_new_only(outputs, new, make_fingerprinter)
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _runs(connection: sqlite3.Connection, target: str, since: Optional[str]) -> Iterator[sqlite3.Row]:
+    if since is None:
+        yield from connection.execute('SELECT * FROM runs WHERE target = ? ORDER BY started DESC, id DESC LIMIT 1',
+                                      (target,))
+        return
+    try:
+        started = datetime.datetime.fromisoformat(since).timestamp()
+    except ValueError:
+        logger.error(f'Invalid point in time {since}, expected an ISO 8601 date or date and time')
+        sys.exit(1)
+    yield from connection.execute('SELECT * FROM runs WHERE target = ? AND started >= ?', (target, started))
+
+
+def history(args: argparse.Namespace) -> None:
+    target = str(Path(args.target or '.').resolve())
+    if not HISTORY_FILE.is_file():
+        logger.error('No findings have been recorded yet, use run --history to record them')
+        sys.exit(1)
+
+    console = Console()
+    with closing(connect()) as connection:
+        if args.query == 'noisy':
+            table = Table(title=f'Rules with the most open findings in {target}', box=box.SIMPLE)
+            table.add_column('Rule', style='blue')
+            table.add_column('Findings', style='green', justify='right')
+            for row in connection.execute('SELECT rule, COUNT(*) AS findings FROM findings '
+                                          'WHERE target = ? AND fixed_run IS NULL GROUP BY rule '
+                                          'ORDER BY findings DESC, rule LIMIT ?', (target, args.limit)):
+                table.add_row(row['rule'], str(row['findings']))
+            console.print(table)
+            return
+
+        runs = list(_runs(connection, target, args.since))
+        if not runs:
+            logger.info(f'No runs have been recorded for {target}')
+            return
+        column = 'introduced_run' if args.query == 'new' else 'fixed_run'
+        title = 'New' if args.query == 'new' else 'Fixed'
+        table = Table(title=f'{title} findings in {target} since {_format_time(min(run["started"] for run in runs))}',
+                      box=box.SIMPLE)
+        table.add_column('Rule', style='blue')
+        table.add_column('Location')
+        table.add_column('Run', style='green')
+        for run in runs:
+            for row in connection.execute(f'SELECT rule, path, line FROM findings WHERE target = ? AND {column} = ? '
+                                          f'ORDER BY path, line LIMIT ?', (target, run['id'], args.limit)):
+                table.add_row(row['rule'], f'{row["path"]}:{row["line"]}', _format_time(run['started']))
+        console.print(table)
@@ -0,0 +1,238 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+from tinydb import Query, TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+from ruamel.yaml import YAML
+
+from semgrep_search.const import LOCAL_DB_FILE
+from semgrep_search.targets import IGNORED_DIRECTORIES
+from semgrep_search.utils import fix_languages, hash_rule, logger, measure_time
+
+if TYPE_CHECKING:
+    import argparse
+
+RULE_SUFFIXES = ('.yaml', '.yml')
+# Files are handed to the worker processes in chunks, parsing a single file is too cheap to be worth a round-trip
+CHUNK_SIZE = 32
+# Files ingested with a different format of the stored rules are parsed again
+CONTENT_FORMAT = 2
+
+# Round-trip, so the stored rules keep the comments and the scalars exactly as they are written in the rule files
+yaml = YAML(typ='rt')
+yaml.preserve_quotes = True
+# Long scalars are not wrapped
+yaml.width = 1 << 16
+
+
+def find_rule_files(directory: Path) -> list[Path]:
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if name not in IGNORED_DIRECTORIES and not name.startswith('.')]
+        files.extend(Path(root) / name for name in names if name.endswith(RULE_SUFFIXES))
+    return files
+
+
+def _plain(value: object) -> object:
+    # Strings keep the type of their quotes when round-tripped, which is of no use outside the content
+    return str(value) if isinstance(value, str) else value
+
+
+def parse_rule_file(path: str) -> tuple[str, str, list[dict], Optional[str]]:
+    """
+    Parses all rules of a file into database records. Runs in a worker process.
+    Returns the path, the hash of the file, the rules and an error message if the file could not be parsed.
+    """
+    try:
+        with open(path, 'rb') as stream:
+            data = stream.read()
+        digest = hashlib.sha256(data).hexdigest()
+        document = yaml.load(data)
+    except Exception as e:
+        return path, '', [], str(e)
+
+    # Test targets, CI configurations and the like do not contain rules
+    if not isinstance(document, dict) or not isinstance(document.get('rules'), list):
+        return path, digest, [], None
+
+    records = []
+    for rule in document['rules']:
+        if not isinstance(rule, dict) or 'id' not in rule:
+            continue
+        metadata = rule.get('metadata') if isinstance(rule.get('metadata'), dict) else {}
+        content = io.StringIO()
+        yaml.dump(rule, content)
+        records.append({
+            'id': str(rule['id']),
+            'languages': sorted(str(language) for language in fix_languages(rule.get('languages') or [])),
+            'severity': _plain(rule.get('severity')),
+            'category': _plain(metadata.get('category')),
+            'content': content.getvalue(),
+        })
+    return path, digest, records, None
+
+
+def local_digest(local: TinyDB) -> Optional[str]:
+    """Identifies the current set of local rules, so that artifacts derived from the database can be invalidated"""
+    hashes = sorted(hash_rule(rule) for rule in local.table('rules'))
+    if not hashes:
+        return None
+    return hashlib.sha256('\n'.join(hashes).encode('utf-8')).hexdigest()
+
+
+def applied_state(db: TinyDB) -> Optional[dict]:
+    """The digest and origins of the local rules that were last applied to the database"""
+    metadata = db.table('meta').all()
+    return metadata[0].get('local') if metadata else None
+
+
+def apply_local_rules(db: TinyDB) -> None:
+    """
+    Replaces the rules of all local origins in the database with the ingested ones.
+    Called after ingesting and after the database was updated, as an update replaces the whole database.
+    """
+    if not LOCAL_DB_FILE.is_file():
+        return
+    local = TinyDB(LOCAL_DB_FILE)
+    try:
+        meta = db.table('meta')
+        current = applied_state(db)
+        state = {'digest': local_digest(local), 'origins': sorted(repo['id'] for repo in local.table('repos'))}
+        if current == state:
+            return
+        # Origins that no longer exist locally have to be removed as well
+        origins = set(state['origins']) | set(current['origins'] if current else [])
+
+        rules = db.table('rules')
+        rules.remove(Query().source.one_of(list(origins)))
+        rules.insert_multiple({key: value for key, value in rule.items() if key != 'file'}
+                              for rule in local.table('rules'))
+        repos = db.table('repos')
+        repos.remove(Query().id.one_of(list(origins)))
+        repos.insert_multiple(dict(repo) for repo in local.table('repos'))
+        if len(meta):
+            meta.update({'local': state})
+        logger.debug(f'Applied {len(local.table("rules"))} local rules to the database')
+    finally:
+        local.close()
+
+
+def ingest_directories(local: TinyDB, directories: list[Path], origin: str, jobs: int) -> tuple[int, int, int]:
+    """
+    Re-parses all rule files of the directories that changed since they were ingested the last time.
+    Returns the number of changed, unchanged and removed files.
+    """
+    File = Query()
+    files = local.table('files')
+    rules = local.table('rules')
+    known = {entry['path']: entry for entry in files.search(File.origin == origin)}
+
+    stats = {}
+    for directory in directories:
+        for path in find_rule_files(directory):
+            try:
+                stats[str(path)] = path.stat()
+            except OSError:
+                continue
+
+    def is_stale(path: str, stat: os.stat_result) -> bool:
+        entry = known.get(path)
+        return entry is None or (entry['mtime'], entry['size']) != (stat.st_mtime_ns, stat.st_size) \
+            or entry.get('format') != CONTENT_FORMAT
+
+    # Only files whose size or modification time changed are read at all
+    candidates = [path for path, stat in stats.items() if is_stale(path, stat)]
+    # Files of other directories of the same origin are left alone
+    removed = [path for path in known
+               if path not in stats and any(Path(path).is_relative_to(directory) for directory in directories)]
+
+    parsed = []
+    if candidates:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            parsed = list(executor.map(parse_rule_file, candidates, chunksize=CHUNK_SIZE))
+
+    entries = {}
+    changed = []
+    records = []
+    for path, digest, file_records, error in parsed:
+        if error is not None:
+            logger.warning(f'Unable to parse {path}: {error}')
+            continue
+        entries[path] = {'path': path, 'origin': origin, 'mtime': stats[path].st_mtime_ns, 'size': stats[path].st_size,
+                         'hash': digest, 'format': CONTENT_FORMAT}
+        if path in known and known[path]['hash'] == digest and known[path].get('format') == CONTENT_FORMAT:
+            # Touched but not modified, the rules remain as they are
+            continue
+        changed.append(path)
+        records.extend({**record, 'source': origin, 'file': path} for record in file_records)
+
+    rules.remove(File.file.one_of(changed + removed))
+    rules.insert_multiple(records)
+    files.remove(File.path.one_of(list(entries) + removed))
+    files.insert_multiple(entries.values())
+
+    return len(changed), len(stats) - len(candidates), len(removed)
+
+
+def ingest(args: argparse.Namespace, db: TinyDB) -> None:
+    directories = [Path(directory).expanduser().resolve() for directory in args.directories]
+    for directory in directories:
+        if not directory.is_dir():
+            logger.error(f'{directory} is not a directory')
+            sys.exit(1)
+
+    # Buffer all writes until the database is closed, every single write would rewrite the whole file otherwise
+    local = TinyDB(LOCAL_DB_FILE, storage=CachingMiddleware(JSONStorage))
+    try:
+        repos = local.table('repos')
+        applied = applied_state(db)
+        local_origins = {repo['id'] for repo in repos} | set(applied['origins'] if applied else [])
+        if args.origin not in local_origins and db.table('repos').contains(Query().id == args.origin):
+            logger.error(f'Origin {args.origin} already exists in the database, choose a different one with --origin')
+            sys.exit(1)
+
+        with measure_time('Ingested rules in %s', logging.DEBUG):
+            changed, unchanged, removed = ingest_directories(local, directories, args.origin, max(1, args.jobs))
+        repos.upsert({
+            'id': args.origin,
+            'name': args.name or args.origin,
+            'license': args.license,
+            'url': args.url or directories[0].as_uri(),
+        }, Query().id == args.origin)
+
+        origin_rules = local.table('rules').search(Query().source == args.origin)
+        other_ids = {rule['id'] for rule in db.table('rules') if rule.get('source') != args.origin}
+        for rule_id in sorted({rule['id'] for rule in origin_rules} & other_ids):
+            logger.warning(f'Local rule {rule_id} has the same id as a rule from another origin')
+    finally:
+        local.close()
+
+    with measure_time('Applied local rules in %s', logging.DEBUG):
+        apply_local_rules(db)
+    logger.info(f'Ingested {len(origin_rules)} rules of origin {args.origin} '
+                f'({changed} files changed, {unchanged} unchanged, {removed} removed)')
@@ -23,6 +23,7 @@ from rich.console import Console
 from rich.table import Table
 from rich.text import Text
 
+from semgrep_search.cache import DerivedCache
 from semgrep_search.const import LANGUAGES
 from semgrep_search.utils import fix_languages
 
@@ -31,7 +32,7 @@ if TYPE_CHECKING:
     from tinydb import TinyDB
 
 
-def gather_stats(db: TinyDB, args: argparse.Namespace) -> dict:
+def count_rules(db: TinyDB) -> dict:
     rules = db.table('rules')
 
     origins = {}
@@ -49,6 +50,17 @@ def gather_stats(db: TinyDB, args: argparse.Namespace) -> dict:
             languages.setdefault(language, 0)
             languages[language] += 1
 
+    return {
+        'count': len(rules),
+        'origins': origins,
+        'languages': languages,
+    }
+
+
+def gather_stats(db: TinyDB, args: argparse.Namespace) -> dict:
+    stats = DerivedCache.for_db(db).get_or_compute('stats.json', lambda: count_rules(db))
+    languages = stats['languages']
+
     resolved_languages = {}
     for language, names in LANGUAGES.items():
         base = names[0]
@@ -57,8 +69,8 @@ def gather_stats(db: TinyDB, args: argparse.Namespace) -> dict:
         resolved_languages[language] = languages.get(base, 0)
 
     return {
-        'count': len(rules),
-        'origins': origins,
+        'count': stats['count'],
+        'origins': stats['origins'],
         'languages': resolved_languages,
     }
 
@@ -15,16 +15,30 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import datetime
+import functools
+import os
 import sys
+from pathlib import Path
+from typing import Optional
 
 from rich.console import Console
+from tinydb import TinyDB
 
-from semgrep_search.const import DATA_DIR, CATEGORIES, SEVERITIES
+from semgrep_search.const import DATA_DIR, CATEGORIES, SEVERITIES, RULESET_FORMATS
+from semgrep_search.batch import batch
 from semgrep_search.database import get_database
+from semgrep_search.distributed import worker
+from semgrep_search.facets import LEVELS
+from semgrep_search.history import history
+from semgrep_search.ingest import ingest
 from semgrep_search.inspection import inspect
+from semgrep_search.metrics import metrics
 from semgrep_search.run import run
 from semgrep_search.search import search
 from semgrep_search.utils import logger, build_logger, get_metadata, print_verbose_info, get_version
+from semgrep_search.validation import validate
+from semgrep_search.warm import warm
 
 
 def parse_args() -> argparse.Namespace:
@@ -39,6 +53,12 @@ def parse_args() -> argparse.Namespace:
                             help='Force an update of the database')
         parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=0, help='Enable verbose logging')
         parser.add_argument('--database', dest='database', default=None, help='Use a different location for the database')
+        parser.add_argument('--metrics-file', dest='metrics_file', type=Path, default=None,
+                            help='Write metrics in the Prometheus text format to this file when exiting '
+                                 '(e.g. for the textfile collector of the node-exporter)')
+        parser.add_argument('--metrics-push', dest='metrics_push', default=None, metavar='URL',
+                            help='Push metrics in the Prometheus text format to this URL when exiting '
+                                 '(e.g. http://localhost:9091/metrics/job/sgs for a Pushgateway)')
 
     def add_filters(parser: argparse.ArgumentParser):
         parser.add_argument('--language', '-l', action='append', help='The language(s) to filter for. '
@@ -52,8 +72,28 @@ def parse_args() -> argparse.Namespace:
         parser.add_argument('--origin', '-o', action='append', help='The origin(s) to select rules from. '
                                                                     'Specify multiple origins by providing this argument multiple times '
                                                                     'or by separating them by comma')
+        parser.add_argument('--cwe', dest='cwes', action='append', metavar='CWE',
+                            help='Only select rules for these CWEs (e.g. CWE-89). '
+                                 'Specify multiple CWEs by providing this argument multiple times or by separating them '
+                                 'by comma')
+        parser.add_argument('--owasp', action='append', metavar='CATEGORY',
+                            help='Only select rules for these OWASP Top 10 categories (e.g. A03:2021). '
+                                 'Specify multiple categories by providing this argument multiple times or by '
+                                 'separating them by comma')
+        for facet in ('confidence', 'likelihood', 'impact'):
+            parser.add_argument(f'--{facet}', action='append', type=str.upper, choices=LEVELS,
+                                help=f'Only select rules whose metadata specifies this {facet}. '
+                                     f'Specify multiple values by providing this argument multiple times')
         parser.add_argument('--include-empty', '-e', action='store_true', default=False,
                             help='Include rules that do not specify a selected filter at all')
+        parser.add_argument('--rule', action='append', metavar='ID',
+                            help='Only select rules with this id or matching this glob pattern. '
+                                 'Specify multiple ids by providing this argument multiple times, by separating them '
+                                 'by comma or by providing a file with one id per line as @FILE')
+        parser.add_argument('--exclude-rule', action='append', metavar='ID',
+                            help='Exclude rules with this id or matching this glob pattern. '
+                                 'Specify multiple ids by providing this argument multiple times, by separating them '
+                                 'by comma or by providing a file with one id per line as @FILE')
 
     def add_outputs(parser: argparse.ArgumentParser):
         parser.add_argument('--text', default=True, action=argparse.BooleanOptionalAction, help='Output a text file')
@@ -70,8 +110,20 @@ def parse_args() -> argparse.Namespace:
 
     search.add_argument('--output', '-O', default='rules.yaml',
                         help='Output file that contains all matched rules (- for stdout)')
+    search.add_argument('--format', '-F', choices=RULESET_FORMATS, default=None,
+                        help='Format of the ruleset (defaults to json for files ending in .json, otherwise yaml). '
+                             'semgrep loads JSON rulesets faster')
     add_commons(search)
 
+    batch = subparsers.add_parser('batch', help='Generate many rulesets at once, loading the database only once')
+    batch.add_argument('specs', metavar='SPECS',
+                       help='File (- for stdin) with one ruleset per line: the output file followed by a run '
+                            'configuration string or a filter specification like '
+                            '"languages=python,js;categories=security;include_empty"')
+    batch.add_argument('--format', '-F', choices=RULESET_FORMATS, default=None,
+                       help='Format of the rulesets (defaults to json for files ending in .json, otherwise yaml)')
+    add_commons(batch)
+
     run = subparsers.add_parser('run',
                                 help='Run either the specified configuration short code or use the specified filters')
 
@@ -85,9 +137,101 @@ def parse_args() -> argparse.Namespace:
                      help='Specify the path to the semgrep binary (defaults to searching for "semgrep" in PATH)')
     run.add_argument('--keep-rules-file', action='store_true', default=False,
                      help='If set, the temporary file containing the rules will not be deleted')
+    run.add_argument('--rules-format', choices=RULESET_FORMATS, default='yaml',
+                     help='Format of the generated ruleset, semgrep loads JSON rulesets faster')
+    run.add_argument('--enrich', action='store_true', default=False,
+                     help='Add origin, repository, license and normalized severity from the database '
+                          'to the findings in JSON and SARIF outputs')
+    run.add_argument('--delta', nargs='?', const='', default=None, metavar='COMMIT',
+                     help='Only run rules that were added or modified since the given database commit '
+                          '(defaults to the version replaced by the last update) and merge the findings into the '
+                          'existing JSON and SARIF outputs')
+    run.add_argument('--prefilter', action='store_true', default=False,
+                     help='Exclude rules requiring identifiers that do not appear in any file of the target')
+    run.add_argument('--prioritized', action='store_true', default=False,
+                     help='Run the rules by severity, starting with the most severe ones, and report the findings of '
+                          'each severity as soon as it completed')
+    run.add_argument('--fail-fast', action='store_true', default=False,
+                     help='With --prioritized, skip the remaining severities and exit with code 1 '
+                          'once rules of severity ERROR (or higher) reported findings')
+    run.add_argument('--history', action='store_true', default=False,
+                     help='Record the findings in the local history to track new and fixed findings across runs')
+    run.add_argument('--new-only', action='store_true', default=False,
+                     help='With --history, only keep the findings in the JSON and SARIF outputs that the previous run '
+                          'of the same target did not report')
+    run.add_argument('--shards', type=int, default=1,
+                     help='Split the target into this many parts of about the same size and '
+                          'run a semgrep process for each of them in parallel')
+    run.add_argument('--shard-by-directory', action='store_true', default=False,
+                     help='Never split the top-level directories of the target across shards')
+    run.add_argument('--watch', action='store_true', default=False,
+                     help='After the scan, keep watching the target and rescan files once they changed, '
+                          'updating their findings in the JSON and SARIF outputs')
+    run.add_argument('--distribute', default=None, metavar='QUEUE',
+                     help='Publish the scan as jobs to the queue (a directory shared with the workers), wait for '
+                          'workers to run them and merge their outputs. The target is split using --shards. '
+                          'The jobs of the previous session in the queue are removed')
+    run.add_argument('--rule-shards', type=int, default=1,
+                     help='With --distribute, additionally split the rules into this many parts')
+    run.add_argument('--lease', type=float, default=60,
+                     help='With --distribute, retry the jobs of workers that did not renew their lease '
+                          'for this many seconds')
     add_commons(run)
     add_outputs(run)
 
+    validate = subparsers.add_parser('validate',
+                                     help='Validate rules against the installed semgrep version and quarantine '
+                                          'the rules that fail to load')
+    add_filters(validate)
+    validate.add_argument('--binary', '-b', dest='binary', default=None,
+                          help='Specify the path to the semgrep binary (defaults to searching for "semgrep" in PATH)')
+    validate.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                          help='Number of semgrep processes to run in parallel')
+    validate.add_argument('--batch-size', type=int, default=250,
+                          help='Number of rules validated by a single semgrep process')
+    add_commons(validate)
+
+    warm = subparsers.add_parser('warm',
+                                 help='Fetch the database and precompute everything derived from it, '
+                                      'e.g. when building container images')
+    warm.add_argument('codes', metavar='CODE', nargs='*', default=[],
+                      help='Run configuration strings to pre-generate rulesets for')
+    add_commons(warm)
+
+    ingest = subparsers.add_parser('ingest',
+                                   help='Add the rules of local directories to the database under their own origin, '
+                                        'only files that changed since the last ingestion are parsed again')
+    ingest.add_argument('directories', metavar='DIRECTORY', nargs='+', help='Directories containing rule files')
+    ingest.add_argument('--origin', default='local', help='The origin to store the rules under')
+    ingest.add_argument('--name', default=None, help='Name of the repository of the origin (defaults to the origin)')
+    ingest.add_argument('--license', default=None, help='License of the rules')
+    ingest.add_argument('--url', default=None, help='URL of the repository (defaults to the first directory)')
+    ingest.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes parsing rule files in parallel')
+    add_commons(ingest)
+
+    history = subparsers.add_parser('history', help='Query the findings recorded by run --history')
+    history.add_argument('query', choices=['new', 'fixed', 'noisy'],
+                         help='new: findings introduced by a run, fixed: findings that disappeared in a run, '
+                              'noisy: rules with the most open findings')
+    history.add_argument('--target', default=None,
+                         help='The target the findings were recorded for (defaults to the working directory)')
+    history.add_argument('--since', default=None, metavar='DATE',
+                         help='Include all runs since this ISO 8601 date instead of only the last run')
+    history.add_argument('--limit', type=int, default=50, help='Maximum number of rows to print per run')
+    add_commons(history)
+
+    worker = subparsers.add_parser('worker', help='Run the jobs published by run --distribute')
+    worker.add_argument('queue', metavar='QUEUE', help='The queue to pull jobs from')
+    worker.add_argument('--target', default=None,
+                        help='Where the target is located on this machine (defaults to the path used by run)')
+    worker.add_argument('--binary', '-b', dest='binary', default=None,
+                        help='Specify the path to the semgrep binary (defaults to searching for "semgrep" in PATH)')
+    worker.add_argument('--id', default=None, help='Name of the worker in logs (defaults to hostname and process id)')
+    worker.add_argument('--wait', action='store_true', default=False,
+                        help='Keep waiting for new scans instead of exiting once the current one completed')
+    add_commons(worker)
+
     inspect = subparsers.add_parser('inspect', help='Print stats about all rules within the database')
     inspect.add_argument('--hide-empty', dest='hide_empty', action='store_true', default=False,
                          help='If set, do not show empty rows in tables')
@@ -100,13 +244,21 @@ def main() -> int:
     args = parse_args()
     build_logger(args)
 
-    # Ensure the data directory exists
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        return execute(args)
+    finally:
+        metrics.flush(args.metrics_file, args.metrics_push)
 
-    db = get_database(args)
+
+def load_database(args: argparse.Namespace) -> Optional[TinyDB]:
+    """
+    Loads (and updates) the database and checks its metadata
+    """
+    with metrics.timer('sgs_database_load_seconds_total', 'Time spent loading (and updating) the database'):
+        db = get_database(args)
     if db is None:
         logger.error('Failed to load the database')
-        return 1
+        return None
 
     meta = get_metadata(db)
     if not meta:
@@ -114,6 +266,14 @@ def main() -> int:
                        'If errors occur, consider updating the database.')
     else:
         Console().print(print_verbose_info(meta))
+        metrics.gauge('sgs_database_info', 1, 'Version and commit of the database',
+                      commit=meta['commit'], version=str(meta['version']))
+        created_on = meta['created_on']
+        if created_on.tzinfo is None:
+            created_on = created_on.replace(tzinfo=datetime.timezone.utc)
+        metrics.gauge('sgs_database_age_seconds',
+                      (datetime.datetime.now(datetime.timezone.utc) - created_on).total_seconds(),
+                      'Time since the database was created')
 
     if meta['min_version'] is None:
         logger.warning('Database metadata does not specify a minimum semgrep-search version. '
@@ -122,12 +282,42 @@ def main() -> int:
         logger.warning('Database requires a newer version (%s) of semgrep-search than the installed one (%s). '
                        'Please consider updating your semgrep-search installation.', str(meta['min_version']),
                        str(get_version()))
+    return db
+
+
+def execute(args: argparse.Namespace) -> int:
+    # Ensure the data directory exists
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+    if args.command == 'worker':
+        # Workers only run semgrep, they do not need the database
+        return worker(args)
+
+    if args.command == 'history':
+        # The history is independent of the database
+        history(args)
+        return 0
+
+    if args.command == 'run':
+        # The database is loaded while run already resolves semgrep and scans the target
+        run(args, functools.partial(load_database, args))
+        return 0
+
+    db = load_database(args)
+    if db is None:
+        return 1
 
     match args.command:
         case 'search':
             search(args, db)
-        case 'run':
-            run(args, db)
+        case 'batch':
+            batch(args, db)
+        case 'validate':
+            validate(args, db)
+        case 'warm':
+            warm(args, db)
+        case 'ingest':
+            ingest(args, db)
         case 'inspect':
             inspect(args, db)
 
@@ -0,0 +1,194 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Manifest of the files of a target, stored in SQLite per target.
+
+Every file is recorded with its size, modification time, language and a hash of its content (and, once the prefilter
+asked for them, the identifiers it contains). Refreshing the manifest only stats the files of the target,
+files whose size and modification time did not change are not read again.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+
+from semgrep_search.const import LANGUAGE_EXTENSIONS, LANGUAGE_FILENAMES, MANIFEST_DIR
+from semgrep_search.metrics import metrics
+from semgrep_search.prefilter import TARGET_IDENTIFIER
+from semgrep_search.targets import IGNORED_DIRECTORIES, DirectoryTree, join
+from semgrep_search.utils import logger, measure_time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    language TEXT,
+    hash TEXT NOT NULL,
+    tokens TEXT
+) WITHOUT ROWID;
+'''
+
+# Files modified this shortly before the refresh started may be modified again within the resolution of the
+# modification time, so they are read again by the next refresh
+RACY_NANOSECONDS = 2_000_000_000
+
+
+@dataclass
+class Changes:
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.removed)
+
+
+@dataclass
+class TargetFiles:
+    """
+    The files of a target after refreshing its manifest. Paths are relative to the target.
+    """
+    root: Path
+    sizes: dict[str, int]
+    changes: Changes
+    # Only collected if requested, in lowercase
+    identifiers: Optional[set[str]] = None
+
+    def tree(self) -> DirectoryTree:
+        return DirectoryTree.from_files(self.root, self.sizes)
+
+
+def manifest_file(root: Path) -> Path:
+    return MANIFEST_DIR / f'{hashlib.sha256(str(root).encode("utf-8")).hexdigest()[:16]}.sqlite'
+
+
+def connect(root: Path) -> sqlite3.Connection:
+    file = manifest_file(root)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(file)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def detect_language(path: str) -> Optional[str]:
+    name = path.rpartition('/')[2].lower()
+    return LANGUAGE_FILENAMES.get(name) or LANGUAGE_EXTENSIONS.get(os.path.splitext(name)[1])
+
+
+def walk(root: Path) -> Iterator[tuple[str, os.stat_result]]:
+    """Lists the files of the target with their stats, following symbolic links to files but not to directories"""
+    if root.is_file():
+        yield root.name, root.stat()
+        return
+    pending = ['']
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(root / directory) as entries:
+                for entry in entries:
+                    path = join(directory, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in IGNORED_DIRECTORIES:
+                            pending.append(path)
+                    elif entry.is_file():
+                        yield path, entry.stat()
+        except OSError as e:
+            logger.debug(f'Unable to list {root / directory}: {e}')
+
+
+def read_file(file: Path, identifiers: bool) -> Optional[tuple[str, Optional[str]]]:
+    """The hash of the content of a file and the identifiers it contains"""
+    try:
+        data = file.read_bytes()
+    except OSError as e:
+        logger.debug(f'Unable to read {file}: {e}')
+        return None
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if not identifiers:
+        return digest, None
+    return digest, ' '.join(sorted(token.decode('ascii') for token in set(TARGET_IDENTIFIER.findall(data.lower()))))
+
+
+def refresh_manifest(target: Path, identifiers: bool = False) -> TargetFiles:
+    """
+    Updates the manifest of the target and lists its files. Only new and modified files are read
+    (and files whose identifiers were not collected yet, if identifiers are requested).
+    """
+    root = target.resolve()
+    base = root.parent if root.is_file() else root
+    started = time.time_ns()
+    with measure_time('Refreshed the manifest of the target in %s', logging.DEBUG), \
+            closing(connect(root)) as connection:
+        known = {row[0]: row[1:] for row in connection.execute(
+            'SELECT path, size, mtime, hash, tokens IS NOT NULL FROM files')}
+        is_new = not known
+
+        sizes: dict[str, int] = {}
+        stale: list[tuple[str, os.stat_result]] = []
+        for path, stat in walk(root):
+            sizes[path] = stat.st_size
+            entry = known.get(path)
+            if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns) or (identifiers and not entry[3]):
+                stale.append((path, stat))
+
+        changes = Changes(removed=sorted(set(known) - set(sizes)))
+        rows = []
+        with ThreadPoolExecutor() as executor:
+            contents = executor.map(lambda item: read_file(base / item[0], identifiers), stale)
+            for (path, stat), content in zip(stale, contents):
+                if content is None:
+                    continue
+                digest, found = content
+                if path not in known:
+                    changes.added.append(path)
+                elif known[path][2] != digest:
+                    changes.modified.append(path)
+                mtime = stat.st_mtime_ns if stat.st_mtime_ns < started - RACY_NANOSECONDS else 0
+                rows.append((path, stat.st_size, mtime, detect_language(path), digest, found))
+
+        with connection:
+            connection.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in changes.removed))
+            connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+        tokens = None
+        if identifiers:
+            tokens = set()
+            for row in connection.execute('SELECT tokens FROM files WHERE tokens IS NOT NULL'):
+                tokens.update(row[0].split())
+        languages = connection.execute('SELECT language, COUNT(*) FROM files GROUP BY language').fetchall()
+
+    metrics.inc('sgs_manifest_files_read_total', 'Number of files read to refresh the manifest of a target', len(rows))
+    for language, count in languages:
+        metrics.gauge('sgs_target_files', count, 'Number of files of the target by language',
+                      language=language or 'unknown')
+    if is_new:
+        logger.info(f'Created the manifest of the target: {len(sizes)} files')
+    else:
+        logger.log(logging.INFO if changes else logging.DEBUG,
+                   f'The target has {len(sizes)} files, {len(changes.added)} added, {len(changes.modified)} modified '
+                   f'and {len(changes.removed)} removed since the last run')
+    return TargetFiles(base, sizes, changes, tokens)
@@ -0,0 +1,114 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+import requests
+
+from semgrep_search.utils import atomic_write, logger
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """
+    Collects metrics for the lifetime of the process and renders them in the Prometheus text format,
+    as understood by the textfile collector of the node-exporter and the Pushgateway
+    """
+
+    def __init__(self) -> None:
+        self._types: dict[str, tuple[str, str]] = {}
+        self._samples: dict[str, dict[Labels, float]] = {}
+        # The phases of a run record metrics from multiple threads
+        self._lock = threading.Lock()
+
+    def _series(self, name: str, metric_type: str, description: str) -> dict[Labels, float]:
+        self._types.setdefault(name, (metric_type, description))
+        return self._samples.setdefault(name, {})
+
+    def gauge(self, name: str, value: float, description: str, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series(name, 'gauge', description)[key] = value
+
+    def inc(self, name: str, description: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series(name, 'counter', description)
+            series[key] = series.get(key, 0) + value
+
+    def samples(self, name: str) -> list[tuple[dict[str, str], float]]:
+        """The current values of a metric with their labels"""
+        with self._lock:
+            return [(dict(labels), value) for labels, value in self._samples.get(name, {}).items()]
+
+    def cache(self, cache: str, *, hit: bool) -> None:
+        self.inc('sgs_cache_requests_total', 'Lookups of derived artifacts by cache and result',
+                 cache=cache, result='hit' if hit else 'miss')
+
+    @contextmanager
+    def timer(self, name: str, description: str, **labels: str) -> Iterator[None]:
+        """Adds the time spent within the block to the counter name (which should end with _seconds_total)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, description, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._samples.items()):
+            metric_type, description = self._types[name]
+            lines.append(f'# HELP {name} {_escape(description)}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in series.items():
+                label_str = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+                lines.append(f'{name}{{{label_str}}} {_format_value(value)}' if label_str
+                             else f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self, file: Optional[Path] = None, push_url: Optional[str] = None) -> None:
+        if file is None and push_url is None:
+            return
+        self.gauge('sgs_last_flush_timestamp_seconds', time.time(), 'Time the metrics were written')
+        text = self.render()
+        if file is not None:
+            # The textfile collector may read the file at any time, so it has to be replaced in one step
+            with atomic_write(file) as stream:
+                stream.write(text)
+        if push_url is not None:
+            try:
+                requests.put(push_url, data=text.encode('utf-8'), timeout=10,
+                             headers={'Content-Type': 'text/plain; version=0.0.4'}).raise_for_status()
+            except requests.RequestException as e:
+                logger.warning(f'Unable to push metrics to {push_url}: {e}')
+
+
+metrics = Metrics()
@@ -0,0 +1,130 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from semgrep_search.metrics import metrics
+from semgrep_search.utils import logger
+
+
+class PhaseExit(Exception):
+    """
+    A phase called sys.exit. Raised instead of SystemExit, which asyncio does not pass on to the awaiting tasks.
+    """
+
+    def __init__(self, code: Any) -> None:
+        super().__init__(f'Exited with {code}')
+        self.code = code
+
+
+@dataclass
+class Phase:
+    name: str
+    dependencies: tuple[str, ...]
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0
+        return self.finished - self.started
+
+
+class Pipeline:
+    """
+    Runs the phases of a command as soon as the phases they depend on completed. Blocking phases are run in the
+    default executor, so phases that do not depend on each other overlap.
+    Every phase receives the results of its dependencies as arguments.
+    Used as async context manager, all remaining phases are cancelled if the block fails.
+    """
+
+    def __init__(self) -> None:
+        self.phases: dict[str, Phase] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._origin = time.perf_counter()
+
+    def add(self, name: str, func: Callable[..., Union[Any, Awaitable[Any]]], *dependencies: str) -> asyncio.Task:
+        phase = Phase(name, dependencies)
+        self.phases[name] = phase
+        waits_for = [self._tasks[dependency] for dependency in dependencies]
+
+        async def execute() -> Any:
+            results = await asyncio.gather(*waits_for)
+            phase.started = time.perf_counter() - self._origin
+            try:
+                if inspect.iscoroutinefunction(func):
+                    return await func(*results)
+                return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *results))
+            except SystemExit as e:
+                raise PhaseExit(e.code) from None
+            finally:
+                phase.finished = time.perf_counter() - self._origin
+
+        self._tasks[name] = asyncio.create_task(execute(), name=name)
+        return self._tasks[name]
+
+    async def result(self, name: str) -> Any:
+        return await self._tasks[name]
+
+    async def __aenter__(self) -> 'Pipeline':
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type], exc: Optional[BaseException], tb: Any) -> None:
+        if exc_type is None:
+            return
+        for task in self._tasks.values():
+            task.cancel()
+        # Collects the results of all phases, so failures of phases nobody waited for are not reported again
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def critical_path(self) -> list[Phase]:
+        """
+        The chain of phases that determined the total duration: starting with the phase finishing last,
+        every phase was waiting for the dependency that finished last
+        """
+        completed = [phase for phase in self.phases.values() if phase.finished is not None]
+        if not completed:
+            return []
+        path = [max(completed, key=lambda phase: phase.finished)]
+        while True:
+            dependencies = [self.phases[name] for name in path[-1].dependencies
+                            if self.phases[name].finished is not None]
+            if not dependencies:
+                break
+            path.append(max(dependencies, key=lambda phase: phase.finished))
+        return path[::-1]
+
+    def report(self) -> None:
+        critical = self.critical_path()
+        for phase in self.phases.values():
+            if phase.finished is None:
+                continue
+            logger.debug(f'Phase {phase.name}: {phase.started:.3f}s - {phase.finished:.3f}s ({phase.duration:.3f}s)')
+            metrics.gauge('sgs_phase_duration_seconds', phase.duration, 'Wall time of the phases of the last run',
+                          phase=phase.name, critical=str(phase in critical).lower())
+        if critical and logger.isEnabledFor(logging.INFO):
+            total = critical[-1].finished
+            logger.info(f'Critical path ({total:.2f}s): '
+                        f'{" -> ".join(f"{phase.name} {phase.duration:.2f}s" for phase in critical)}')
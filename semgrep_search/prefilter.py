@@ -0,0 +1,192 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Excludes rules that cannot match a target, because identifiers their patterns require do not appear in any file.
+
+The requirements of a rule are a conjunction of clauses, each clause being a set of alternative identifiers.
+Everything that cannot be decided reliably (regular expressions, strings, generic rules, ...) does not add a
+requirement, so rules are only ever excluded if they cannot match.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Any, Optional, TYPE_CHECKING
+
+from yaml import load as load_yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from semgrep_search.cache import DerivedCache
+from semgrep_search.metrics import metrics
+from semgrep_search.targets import IGNORED_DIRECTORIES
+from semgrep_search.utils import logger, measure_time
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+
+# A conjunction of clauses, an empty list does not require anything
+Requirements = list[list[str]]
+
+# Rules of these languages do not match on identifiers of a parsed program
+SKIPPED_LANGUAGES = {'generic', 'regex', 'none'}
+# semgrep matches some constructs regardless of the keyword used, e.g. function patterns also match arrow functions,
+# and imports are matched regardless of their form
+IGNORED_KEYWORDS = {'async', 'await', 'class', 'const', 'def', 'fn', 'func', 'function', 'let', 'var',
+                    'final', 'private', 'protected', 'public', 'static', 'from', 'import', 'require'}
+# Distributing disjunctions over conjunctions can grow exponentially, dropping clauses only weakens the requirements
+MAX_CLAUSES = 32
+
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+TARGET_IDENTIFIER = re.compile(rb'[A-Za-z_][A-Za-z0-9_]*')
+# Metavariables (including $...ARGS), strings and typed metavariables like (String $X) do not require identifiers
+NON_LITERALS = re.compile(r'\$(?:\.\.\.)?\w+|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|\([^()$]*\$\w+\s*\)')
+
+
+def pattern_requirements(pattern: Any) -> Requirements:
+    if not isinstance(pattern, str):
+        return []
+    tokens = {token.lower() for token in IDENTIFIER.findall(NON_LITERALS.sub(' ', pattern))}
+    return [[token] for token in sorted(tokens - IGNORED_KEYWORDS)]
+
+
+def conjunction(*requirements: Requirements) -> Requirements:
+    clauses = {frozenset(clause) for requirement in requirements for clause in requirement}
+    # A clause is implied by any of its subsets
+    minimal = [clause for clause in clauses if not any(other < clause for other in clauses)]
+    return sorted(sorted(clause) for clause in minimal)[:MAX_CLAUSES]
+
+
+def disjunction(requirements: list[Requirements]) -> Requirements:
+    if not requirements or any(not requirement for requirement in requirements):
+        # One of the alternatives does not require anything
+        return []
+    result = [[]]
+    for requirement in requirements:
+        result = [sorted(set(clause) | set(other)) for clause in result for other in requirement][:MAX_CLAUSES]
+    return conjunction(result)
+
+
+def formula_requirements(formula: Any) -> Requirements:
+    """
+    Requirements of a pattern formula, using both the pattern-* keys and the newer match syntax
+    """
+    if isinstance(formula, str):
+        return pattern_requirements(formula)
+    if not isinstance(formula, dict):
+        return []
+
+    requirements = []
+    for key in ('pattern', 'pattern-inside'):
+        if key in formula:
+            requirements.append(pattern_requirements(formula[key]))
+    for key in ('patterns', 'all'):
+        if isinstance(formula.get(key), list):
+            requirements.extend(formula_requirements(child) for child in formula[key])
+    for key in ('pattern-either', 'any'):
+        if isinstance(formula.get(key), list):
+            requirements.append(disjunction([formula_requirements(child) for child in formula[key]]))
+    if 'inside' in formula:
+        requirements.append(formula_requirements(formula['inside']))
+    if 'match' in formula:
+        requirements.append(formula_requirements(formula['match']))
+    # pattern-not, pattern-regex, metavariable-* and the like do not require any identifiers
+    return conjunction(*requirements)
+
+
+def rule_requirements(rule: dict) -> Requirements:
+    try:
+        data = load_yaml(rule['content'], Loader=SafeLoader)
+    except Exception:
+        return []
+    if not isinstance(data, dict):
+        return []
+    languages = data.get('languages') or []
+    if not isinstance(languages, list) or any(str(language).lower() in SKIPPED_LANGUAGES for language in languages):
+        return []
+
+    if data.get('mode') == 'taint':
+        # A finding requires both a source and a sink, sanitizers and propagators are optional
+        def specs(key: str) -> Requirements:
+            values = data.get(key)
+            return disjunction([formula_requirements(value) for value in values]) if isinstance(values, list) else []
+        return conjunction(specs('pattern-sources'), specs('pattern-sinks'))
+    return formula_requirements(data)
+
+
+def compute_requirements(db: TinyDB) -> dict[str, Requirements]:
+    result = {}
+    seen = set()
+    for rule in db.table('rules'):
+        rule_id = rule['id']
+        requirements = rule_requirements(rule)
+        if rule_id in seen:
+            # Rules sharing an id (e.g. a local copy of a registry rule) cannot be told apart, so they are not excluded
+            result.pop(rule_id, None)
+            continue
+        seen.add(rule_id)
+        if requirements:
+            result[rule_id] = requirements
+    return result
+
+
+def load_requirements(db: TinyDB) -> dict[str, Requirements]:
+    with measure_time('Loaded rule requirements in %s', logging.DEBUG):
+        return DerivedCache.for_db(db).get_or_compute('requirements.json', lambda: compute_requirements(db))
+
+
+def target_files(target: Path) -> list[Path]:
+    if target.is_file():
+        return [target]
+    files = []
+    for root, dirs, names in os.walk(target):
+        dirs[:] = [name for name in dirs if name not in IGNORED_DIRECTORIES]
+        files.extend(Path(root) / name for name in names)
+    return files
+
+
+def index_target(target: Path) -> set[str]:
+    """
+    Collects all identifiers appearing in any file of the target, in lowercase
+    """
+    tokens: set[bytes] = set()
+    for file in target_files(target):
+        try:
+            data = file.read_bytes()
+        except OSError:
+            continue
+        tokens.update(TARGET_IDENTIFIER.findall(data.lower()))
+    return {token.decode('ascii') for token in tokens}
+
+
+def satisfied(requirements: Optional[Requirements], tokens: set[str]) -> bool:
+    return not requirements or all(any(token in tokens for token in clause) for clause in requirements)
+
+
+def prefilter_rules(db: TinyDB, rules: list[dict], tokens: set[str]) -> list[dict]:
+    """Excludes the rules that cannot match a target with the given identifiers (see index_target)"""
+    requirements = load_requirements(db)
+    result = [rule for rule in rules if satisfied(requirements.get(rule['id']), tokens)]
+    metrics.gauge('sgs_rules_selected', len(result), 'Number of rules matching a filter', filter='prefilter')
+    logger.info(f'Excluded {len(rules) - len(result)} of {len(rules)} rules that cannot match the target')
+    return result
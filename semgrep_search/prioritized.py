@@ -0,0 +1,142 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Mapping, Optional, TYPE_CHECKING
+
+from semgrep_search.metrics import metrics
+from semgrep_search.results import DROP, JSON_RESULTS, RuleIdResolver, merge_outputs, normalize_severity, scan_file
+from semgrep_search.utils import logger, write_ruleset
+
+if TYPE_CHECKING:
+    from semgrep_search.runconfig import RunConfig
+
+# Tiers are run from the most to the least severe one
+TIER_ORDER = ('critical', 'high', 'medium', 'low', 'info', 'unknown')
+# Findings of these tiers fail the run (ERROR is high)
+BLOCKING_TIERS = {'critical', 'high'}
+
+
+@dataclass
+class Tier:
+    name: str
+    rules: list[dict]
+
+    @property
+    def blocking(self) -> bool:
+        return self.name in BLOCKING_TIERS
+
+
+@dataclass
+class PrioritizedResult:
+    rc: int
+    blocking_findings: int
+    skipped: list[str]
+
+
+def partition(rules: list[dict]) -> list[Tier]:
+    tiers: dict[str, list[dict]] = {}
+    for rule in rules:
+        tiers.setdefault(normalize_severity(rule.get('severity')) or 'unknown', []).append(rule)
+    return [Tier(name, tiers[name]) for name in TIER_ORDER if name in tiers]
+
+
+def report_findings(file: Path, tier: Tier) -> int:
+    """
+    Logs the findings of a tier as soon as it completed. Returns the number of findings.
+    """
+    resolver = RuleIdResolver([rule['id'] for rule in tier.rules])
+    count = 0
+
+    def report(result: dict) -> object:
+        nonlocal count
+        count += 1
+        if tier.blocking:
+            logger.warning(f'{result.get("path")}:{result.get("start", {}).get("line")}: '
+                           f'{resolver.resolve(result.get("check_id"))}')
+        return DROP
+
+    scan_file(file, {JSON_RESULTS: report})
+    return count
+
+
+def _tier_run(run: RunConfig, tier: Tier, directory: Path) -> RunConfig:
+    tier_run = copy.copy(run)
+    tier_run.output = directory / f'tier-{tier.name}'
+    tier_run.private_json = None
+    tier_run.rules_file = directory / f'rules-{tier.name}.{run.rules_format}'
+    # The findings of every tier are needed as JSON, whether or not the user requested it
+    if 'export_json' not in run.features:
+        tier_run.features = [*run.features, 'export_json']
+    return tier_run
+
+
+def _write_tier(tier_run: RunConfig, tier: Tier, fragments: Optional[Mapping[str, str]]) -> None:
+    with metrics.timer('sgs_ruleset_serialization_seconds_total', 'Time spent serializing rulesets'), \
+            tier_run.rules_file.open('w', encoding='utf-8') as stream:
+        write_ruleset(tier.rules, stream, fragments, tier_run.rules_format)
+    metrics.inc('sgs_ruleset_rules_total', 'Number of rules written to rulesets', len(tier.rules))
+
+
+async def run_prioritized(run: RunConfig, tiers: list[Tier], scan: Callable[[RunConfig], Awaitable[int]],
+                          fragments: Optional[Mapping[str, str]] = None) -> PrioritizedResult:
+    """
+    Runs semgrep once per tier, from the most severe one to the least severe one, and merges the outputs of all tiers.
+    With fail_fast, the remaining tiers are skipped once a tier had blocking findings.
+    scan runs semgrep for a single tier. The ruleset of the next tier is written while semgrep runs the current one.
+    """
+    rc = 0
+    blocking_findings = 0
+    completed: list[Path] = []
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-tiers-') as tmp:
+        tier_runs = [_tier_run(run, tier, Path(tmp)) for tier in tiers]
+        written = loop.run_in_executor(None, _write_tier, tier_runs[0], tiers[0], fragments) if tiers else None
+        for i, (tier, tier_run) in enumerate(zip(tiers, tier_runs)):
+            await written
+            if blocking_findings and run.fail_fast:
+                skipped = [skipped_tier.name for skipped_tier in tiers[i:]]
+                logger.warning(f'Skipping the tiers {", ".join(skipped)} due to blocking findings')
+                break
+            if i + 1 < len(tiers):
+                written = loop.run_in_executor(None, _write_tier, tier_runs[i + 1], tiers[i + 1], fragments)
+
+            logger.info(f'Running {len(tier.rules)} rules of severity {tier.name}')
+            with metrics.timer('sgs_tier_duration_seconds_total', 'Wall time spent running a severity tier',
+                               tier=tier.name):
+                rc = max(rc, await scan(tier_run))
+            completed.append(tier_run.output)
+
+            file = tier_run.output_files()['json']
+            findings = report_findings(file, tier) if file.is_file() else 0
+            metrics.inc('sgs_tier_findings_total', 'Number of findings per severity tier', findings, tier=tier.name)
+            logger.info(f'Found {findings} findings of severity {tier.name}')
+            if tier.blocking:
+                blocking_findings += findings
+        else:
+            skipped = []
+
+        for output_format, destination in run.output_files().items():
+            files = [run.output_files(base)[output_format] for base in completed]
+            merge_outputs(output_format, [file for file in files if file.is_file()], destination, distinct_rules=True)
+
+    return PrioritizedResult(rc, blocking_findings, skipped)
@@ -0,0 +1,76 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Optional, Union, TYPE_CHECKING
+
+from semgrep_search.const import QUARANTINE_FILE
+from semgrep_search.semgrep import get_semgrep_version
+from semgrep_search.utils import atomic_write, get_commit, logger
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+    from semgrep_search.search import FilterConfig
+
+
+def load_quarantine_file() -> dict[str, dict[str, list[str]]]:
+    if not QUARANTINE_FILE.is_file():
+        return {}
+    try:
+        with QUARANTINE_FILE.open('r', encoding='utf-8') as stream:
+            return json.load(stream)
+    except Exception as e:
+        logger.warning(f'Unable to read the quarantine list: {e}')
+        return {}
+
+
+def get_quarantine(commit: Optional[str], binary: Optional[Union[Path, str]],
+                   version: Optional[str] = None) -> set[str]:
+    """
+    Returns the rules that failed to validate for the database commit using the version of the given semgrep binary
+    (which is only determined if it is not known yet)
+    """
+    if commit is None or binary is None:
+        return set()
+    quarantine = load_quarantine_file().get(commit)
+    # Only determine the version of semgrep if there is something quarantined for the database at all
+    if not quarantine:
+        return set()
+    version = version or get_semgrep_version(binary)
+    if version is None:
+        return set()
+    return set(quarantine.get(version, []))
+
+
+def store_quarantine(commit: str, version: str, validated: set[str], failed: set[str]) -> set[str]:
+    quarantine = load_quarantine_file()
+    versions = quarantine.setdefault(commit, {})
+    rules = (set(versions.get(version, [])) - validated) | failed
+    versions[version] = sorted(rules)
+    with atomic_write(QUARANTINE_FILE) as stream:
+        json.dump(quarantine, stream, indent=2)
+    return rules
+
+
+def apply_quarantine(config: FilterConfig, db: TinyDB, binary: Optional[Union[Path, str]],
+                     version: Optional[str] = None) -> None:
+    quarantined = get_quarantine(get_commit(db), binary, version)
+    if quarantined:
+        logger.info(f'Excluding {len(quarantined)} quarantined rules')
+        config.excluded_ids = (config.excluded_ids or set()) | quarantined
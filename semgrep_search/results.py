@@ -0,0 +1,419 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import functools
+import json
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Collection, Iterable, Optional, TextIO, TYPE_CHECKING
+
+from semgrep_search.const import NORMALIZED_SEVERITIES
+from semgrep_search.utils import atomic_write
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# The characters a JSON number can consist of
+_NUMBER = re.compile(r'[-+0-9.eE]*')
+_DECODER = json.JSONDecoder()
+
+# Paths (with '*' for array items) of the arrays containing the findings
+JSON_RESULTS = ('results',)
+SARIF_RESULTS = ('runs', '*', 'results')
+SARIF_RULES = ('runs', '*', 'tool', 'driver', 'rules')
+
+# SARIF only knows levels, map them back to the semgrep severities
+SARIF_LEVELS = {'error': 'ERROR', 'warning': 'WARNING', 'note': 'INFO'}
+
+# Arrays that are combined when merging the outputs of multiple semgrep runs
+MERGED_ARRAYS = {
+    'json': [JSON_RESULTS, ('errors',), ('paths', 'scanned')],
+    'sarif': [SARIF_RESULTS],
+}
+# Arrays that are only combined if the runs used different rules
+RULE_ARRAYS = {
+    'sarif': [SARIF_RULES],
+}
+# Arrays that contain every item only once, even if multiple runs reported it
+# (rules are repeated by every run of the same rules against a different part of the target)
+UNIQUE_ARRAYS = {('paths', 'scanned'), SARIF_RULES}
+
+# Returned by a transformation to remove the item from the array
+DROP = object()
+
+Transforms = dict[tuple[str, ...], Callable[[Any], Any]]
+Appends = dict[tuple[str, ...], Callable[[], Iterable[Any]]]
+
+
+def _sarif_path(result: dict) -> Optional[str]:
+    location = (result.get('locations') or [{}])[0].get('physicalLocation', {})
+    return location.get('artifactLocation', {}).get('uri')
+
+
+# The file an item of a merged array is about
+ITEM_PATHS: dict[tuple[str, ...], Callable[[Any], Optional[str]]] = {
+    JSON_RESULTS: lambda result: result.get('path'),
+    ('errors',): lambda error: error.get('path') if isinstance(error, dict) else None,
+    ('paths', 'scanned'): lambda path: path,
+    SARIF_RESULTS: _sarif_path,
+}
+
+
+class JsonStreamRewriter:
+    """
+    Copies a JSON document from src to dst chunk by chunk, passing every item of the selected arrays through a
+    transformation and adding the items of appends at the end of the selected arrays.
+    Only a single array item is held in memory at a time, everything else is copied verbatim.
+    """
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, src: TextIO, dst: TextIO, transforms: Transforms, appends: Optional[Appends] = None) -> None:
+        self._src = src
+        self._dst = dst
+        self._transforms = transforms
+        self._appends = appends or {}
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def rewrite(self) -> None:
+        self._copy_value(())
+        if self._peek(allow_eof=True) is not None:
+            raise ValueError('Unexpected data after the end of the JSON document')
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._src.read(self.CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self, *, allow_eof: bool = False) -> Optional[str]:
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                if allow_eof:
+                    return None
+                raise ValueError('Unexpected end of JSON document')
+
+    def _skip(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f'Expected "{char}" at offset {self._pos} of the current chunk')
+        self._pos += 1
+
+    def _expect(self, char: str) -> None:
+        self._skip(char)
+        self._dst.write(char)
+
+    def _decode(self) -> tuple[Any, str]:
+        char = self._peek()
+        if char == '-' or char.isdigit():
+            # A number cut off at the end of the current chunk (e.g. after "1." or "1e") would be decoded short
+            while _NUMBER.match(self._buffer, self._pos).end() == len(self._buffer) and self._fill():
+                pass
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            raw = self._buffer[self._pos:end]
+            self._pos = end
+            return value, raw
+
+    def _copy_value(self, path: tuple[str, ...]) -> None:
+        char = self._peek()
+        if char == '{':
+            self._copy_object(path)
+        elif char == '[':
+            self._copy_array(path)
+        else:
+            _, raw = self._decode()
+            self._dst.write(raw)
+
+    def _copy_object(self, path: tuple[str, ...]) -> None:
+        self._expect('{')
+        first = True
+        while self._peek() != '}':
+            if not first:
+                self._expect(',')
+            key, raw = self._decode()
+            self._dst.write(raw)
+            self._expect(':')
+            self._copy_value((*path, key))
+            first = False
+        self._expect('}')
+
+    def _write_item(self, value: Any, written: bool) -> bool:
+        if value is DROP:
+            return written
+        if written:
+            self._dst.write(',')
+        self._dst.write(json.dumps(value))
+        return True
+
+    def _copy_array(self, path: tuple[str, ...]) -> None:
+        transform = self._transforms.get(path)
+        append = self._appends.get(path)
+        self._expect('[')
+
+        if transform is None and append is None:
+            first = True
+            while self._peek() != ']':
+                if not first:
+                    self._expect(',')
+                self._copy_value((*path, '*'))
+                first = False
+            self._expect(']')
+            return
+
+        transform = transform or _identity
+        written = False
+        first = True
+        while self._peek() != ']':
+            if not first:
+                self._skip(',')
+            value, _ = self._decode()
+            written = self._write_item(transform(value), written)
+            first = False
+        if append is not None:
+            for value in append():
+                written = self._write_item(value, written)
+        self._expect(']')
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def rewrite_file(path: Path, transforms: Transforms, appends: Optional[Appends] = None,
+                 destination: Optional[Path] = None) -> None:
+    """
+    Rewrites the JSON document at path into destination (defaults to rewriting it in place).
+    The new document only replaces the destination once it has been written completely.
+    """
+    with path.open('r', encoding='utf-8') as src, atomic_write(destination or path) as dst:
+        JsonStreamRewriter(src, dst, transforms, appends).rewrite()
+
+
+def scan_file(path: Path, transforms: Transforms) -> None:
+    """Passes all items of the selected arrays of the JSON document at path through the transformations"""
+    with path.open('r', encoding='utf-8') as src, open(os.devnull, 'w', encoding='utf-8') as dst:
+        JsonStreamRewriter(src, dst, transforms).rewrite()
+
+
+def count_severities(path: Path, output_format: str) -> dict[str, int]:
+    counts: dict[str, int] = {}
+
+    def count(severity: Optional[str]) -> object:
+        severity = normalize_severity(severity) or 'unknown'
+        counts[severity] = counts.get(severity, 0) + 1
+        return DROP
+
+    if output_format == 'json':
+        scan_file(path, {JSON_RESULTS: lambda result: count(result.get('extra', {}).get('severity'))})
+    else:
+        scan_file(path, {SARIF_RESULTS: lambda result: count(SARIF_LEVELS.get(result.get('level')))})
+    return counts
+
+
+def merge_outputs(output_format: str, files: list[Path], destination: Path, distinct_rules: bool = False) -> None:
+    """
+    Merges the outputs of multiple semgrep runs into destination. If the runs used different rules (distinct_rules),
+    the rule definitions are merged as well.
+    The first output serves as template, the findings of all other outputs are spooled to disk and appended to it.
+    """
+    if output_format == 'text' or not files:
+        with atomic_write(destination) as dst:
+            for file in files:
+                with file.open('r', encoding='utf-8') as src:
+                    shutil.copyfileobj(src, dst)
+        return
+
+    arrays = MERGED_ARRAYS[output_format] + (RULE_ARRAYS.get(output_format, []) if distinct_rules else [])
+    seen: dict[tuple[str, ...], set[str]] = {path: set() for path in arrays if path in UNIQUE_ARRAYS}
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-merge-') as tmp:
+        spools = {path: (Path(tmp) / str(i)).open('w+', encoding='utf-8') for i, path in enumerate(arrays)}
+        try:
+            def spool(path: tuple[str, ...]) -> Callable[[Any], object]:
+                def transform(item: Any) -> object:
+                    spools[path].write(json.dumps(item) + '\n')
+                    return DROP
+                return transform
+
+            for file in files[1:]:
+                scan_file(file, {path: spool(path) for path in arrays})
+
+            def remember(path: tuple[str, ...]) -> Callable[[Any], Any]:
+                def transform(item: Any) -> Any:
+                    seen[path].add(json.dumps(item))
+                    return item
+                return transform
+
+            def read(path: tuple[str, ...]) -> Callable[[], Iterable[Any]]:
+                def items() -> Iterable[Any]:
+                    spools[path].seek(0)
+                    for line in spools[path]:
+                        if path in seen:
+                            if line.rstrip('\n') in seen[path]:
+                                continue
+                            seen[path].add(line.rstrip('\n'))
+                        yield json.loads(line)
+                return items
+
+            rewrite_file(files[0], {path: remember(path) for path in seen}, {path: read(path) for path in arrays},
+                         destination=destination)
+        finally:
+            for stream in spools.values():
+                stream.close()
+
+
+def replace_paths(output_format: str, destination: Path, update: Optional[Path], paths: Collection[str]) -> None:
+    """
+    Replaces everything destination reports about the given paths with the output of a run against only these paths
+    (update, None if none of them exist anymore)
+    """
+    arrays = MERGED_ARRAYS[output_format]
+    replacements: dict[tuple[str, ...], list[Any]] = {path: [] for path in arrays}
+
+    def collect(path: tuple[str, ...]) -> Callable[[Any], object]:
+        def transform(item: Any) -> object:
+            replacements[path].append(item)
+            return DROP
+        return transform
+
+    paths = {posixpath.normpath(path) for path in paths}
+
+    def keep(path: tuple[str, ...]) -> Callable[[Any], Any]:
+        def transform(item: Any) -> Any:
+            item_path = ITEM_PATHS[path](item)
+            # semgrep reports ./file when scanning . and file when scanning the file itself
+            return DROP if item_path is not None and posixpath.normpath(item_path) in paths else item
+        return transform
+
+    if update is not None:
+        scan_file(update, {path: collect(path) for path in arrays})
+    rewrite_file(destination, {path: keep(path) for path in arrays},
+                 {path: functools.partial(iter, replacements[path]) for path in arrays})
+
+
+def normalize_severity(severity: Optional[str]) -> Optional[str]:
+    if severity is None:
+        return None
+    return NORMALIZED_SEVERITIES.get(severity.upper())
+
+
+class RuleIdResolver:
+    """
+    semgrep prefixes the ids of rules loaded from a local file with the path of the file,
+    so leading components are stripped until the id is known
+    """
+
+    def __init__(self, ids: Collection[str]) -> None:
+        self._ids = ids
+        self._resolved: dict[str, Optional[str]] = {}
+
+    def resolve(self, check_id: Optional[str]) -> Optional[str]:
+        if not check_id:
+            return None
+        if check_id in self._resolved:
+            return self._resolved[check_id]
+        candidate = check_id
+        while candidate not in self._ids:
+            _, sep, candidate = candidate.partition('.')
+            if not sep:
+                candidate = None
+                break
+        self._resolved[check_id] = candidate
+        return candidate
+
+
+class RuleIndex:
+    """
+    Maps the check ids reported by semgrep back to the rules (and their repositories) within the database
+    """
+
+    def __init__(self, rules: dict[str, tuple[str, Optional[str]]], repos: dict[str, dict]) -> None:
+        self._rules = rules
+        self._repos = repos
+        self._resolver = RuleIdResolver(rules)
+
+    @staticmethod
+    def from_db(db: TinyDB) -> 'RuleIndex':
+        rules = {rule['id']: (rule.get('source'), rule.get('severity')) for rule in db.table('rules')}
+        repos = {repo['id']: repo for repo in db.table('repos')}
+        return RuleIndex(rules, repos)
+
+    def resolve(self, check_id: Optional[str]) -> Optional[str]:
+        return self._resolver.resolve(check_id)
+
+    def lookup(self, check_id: Optional[str], severity: Optional[str] = None) -> Optional[dict]:
+        rule_id = self.resolve(check_id)
+        if rule_id is None:
+            return None
+        origin, rule_severity = self._rules[rule_id]
+        repo = self._repos.get(origin, {})
+        return {
+            'rule': rule_id,
+            'origin': origin,
+            'repository': repo.get('name'),
+            'license': repo.get('license'),
+            'url': repo.get('url'),
+            'severity': normalize_severity(severity or rule_severity),
+        }
+
+    def enrich_json_result(self, result: dict) -> dict:
+        extra = result.setdefault('extra', {})
+        info = self.lookup(result.get('check_id'), extra.get('severity'))
+        if info is not None:
+            extra.setdefault('metadata', {})['semgrep-search'] = info
+        return result
+
+    def enrich_sarif_result(self, result: dict) -> dict:
+        info = self.lookup(result.get('ruleId'))
+        if info is not None:
+            result.setdefault('properties', {})['semgrep-search'] = info
+        return result
+
+    def enrich_sarif_rule(self, rule: dict) -> dict:
+        info = self.lookup(rule.get('id'))
+        if info is not None:
+            rule.setdefault('properties', {})['semgrep-search'] = info
+        return rule
+
+    def enrich_json(self, path: Path) -> None:
+        rewrite_file(path, {JSON_RESULTS: self.enrich_json_result})
+
+    def enrich_sarif(self, path: Path) -> None:
+        rewrite_file(path, {
+            SARIF_RESULTS: self.enrich_sarif_result,
+            SARIF_RULES: self.enrich_sarif_rule,
+        })
@@ -0,0 +1,107 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import bisect
+import fnmatch
+import re
+from typing import Iterable, Optional, TYPE_CHECKING
+
+from semgrep_search.cache import DerivedCache
+from semgrep_search.utils import logger
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+    from semgrep_search.search import FilterConfig
+
+GLOB_CHARACTERS = re.compile(r'[*?\[]')
+
+
+class RuleIdIndex:
+    """
+    Sorted list of all rule ids of a database version. Globs only have to be matched against the ids sharing
+    their literal prefix, which are adjacent in the list.
+    """
+
+    def __init__(self, ids: list[str]) -> None:
+        self.ids = ids
+        self._known = set(ids)
+
+    @staticmethod
+    def from_db(db: TinyDB) -> 'RuleIdIndex':
+        ids = DerivedCache.for_db(db).get_or_compute('rule_ids.json',
+                                                     lambda: sorted({rule['id'] for rule in db.table('rules')}))
+        return RuleIdIndex(ids)
+
+    def _with_prefix(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self.ids, prefix)
+        end = start
+        while end < len(self.ids) and self.ids[end].startswith(prefix):
+            end += 1
+        return self.ids[start:end]
+
+    def expand(self, patterns: Iterable[str], find_unmatched: bool = False) -> tuple[set[str], set[str]]:
+        """
+        Resolves exact ids and glob patterns to the ids of the database. Returns the matched ids and, if find_unmatched
+        is set, the patterns that did not match any rule.
+        """
+        matched = set()
+        unmatched = set()
+        unprefixed = []
+        for pattern in patterns:
+            glob = GLOB_CHARACTERS.search(pattern)
+            if glob is None:
+                if pattern in self._known:
+                    matched.add(pattern)
+                else:
+                    unmatched.add(pattern)
+            elif glob.start() == 0:
+                unprefixed.append(pattern)
+            else:
+                candidates = [rule_id for rule_id in self._with_prefix(pattern[:glob.start()])
+                              if fnmatch.fnmatchcase(rule_id, pattern)]
+                matched.update(candidates)
+                if not candidates:
+                    unmatched.add(pattern)
+
+        if unprefixed:
+            # Globs without a literal prefix have to look at every id, so they are combined to do that only once
+            regex = re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in unprefixed))
+            candidates = [rule_id for rule_id in self.ids if regex.match(rule_id)]
+            matched.update(candidates)
+            if find_unmatched:
+                unmatched.update(pattern for pattern in unprefixed
+                                 if not any(fnmatch.fnmatchcase(rule_id, pattern) for rule_id in candidates))
+        return matched, unmatched
+
+
+def apply_rule_patterns(config: FilterConfig, db: TinyDB, include: Optional[set[str]],
+                        exclude: Optional[set[str]]) -> None:
+    """
+    Restricts the config to the rules selected by --rule and removes the ones selected by --exclude-rule
+    """
+    if not include and not exclude:
+        return
+    index = RuleIdIndex.from_db(db)
+    if include:
+        included, unmatched = index.expand(include, find_unmatched=True)
+        for pattern in sorted(unmatched):
+            logger.warning(f'No rule matches {pattern}')
+        config.included_ids = (config.included_ids & included) if config.included_ids is not None else included
+    if exclude:
+        excluded, _ = index.expand(exclude)
+        config.excluded_ids = (config.excluded_ids or set()) | excluded
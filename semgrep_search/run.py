@@ -17,74 +17,313 @@
 from __future__ import annotations
 
 import asyncio
-import os
+import functools
+import logging
 import shutil
 import sys
 import tempfile
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import Callable, Optional, Union, TYPE_CHECKING
 
 from rich.console import Console
 from rich.text import Text
 from tinydb import TinyDB
 
+from semgrep_search.cache import DerivedCache, load_fragments
+from semgrep_search.delta import DeltaMerger, RuleDelta
+from semgrep_search.distributed import coordinate
+from semgrep_search.facets import apply_facets
+from semgrep_search.history import track_findings
+from semgrep_search.manifest import refresh_manifest
+from semgrep_search.metrics import metrics
+from semgrep_search.pipeline import Pipeline, PhaseExit
+from semgrep_search.prefilter import prefilter_rules
+from semgrep_search.prioritized import PrioritizedResult, partition, run_prioritized
+from semgrep_search.quarantine import apply_quarantine, load_quarantine_file
+from semgrep_search.results import RuleIndex, count_severities
 from semgrep_search.runconfig import RunConfig
-from semgrep_search.search import filter_rules
-from semgrep_search.semgrep import run_semgrep
-from semgrep_search.utils import logger, write_ruleset
+from semgrep_search.ruleids import apply_rule_patterns
+from semgrep_search.search import filter_rules, read_patterns
+from semgrep_search.semgrep import find_semgrep, get_semgrep_version, run_semgrep
+from semgrep_search.sharding import Shard, plan_shards, run_shards
+from semgrep_search.utils import logger, write_ruleset, measure_time
+from semgrep_search.watch import watch
 
 if TYPE_CHECKING:
     import argparse
 
 
-def run(args: argparse.Namespace, db: TinyDB) -> None:
+def run(args: argparse.Namespace, load_database: Callable[[], Optional[TinyDB]]) -> None:
     print(args)
     try:
         run = RunConfig.from_args(args)
     except ValueError as e:
         logger.error(str(e))
         sys.exit(1)
-    do_run(run, db)
+    include, exclude = read_patterns(args.rule), read_patterns(args.exclude_rule)
+    if include or exclude:
+        logger.warning('Rules selected by id (--rule, --exclude-rule) are not part of the run configuration string')
+    try:
+        asyncio.run(do_run(run, load_database, include, exclude))
+    except PhaseExit as e:
+        sys.exit(e.code)
+    except KeyboardInterrupt:
+        if not run.watch:
+            raise
+        logger.info('Stopped watching the target')
 
 
-def do_run(run: RunConfig, db: TinyDB) -> None:
+async def do_run(run: RunConfig, load_database: Callable[[], Optional[TinyDB]],
+                 include: Optional[set[str]] = None, exclude: Optional[set[str]] = None) -> None:
+    """
+    Runs the phases of a run concurrently where they do not depend on each other: the database is loaded and the
+    rules are selected while the semgrep binary is resolved and probed and the manifest of the target is refreshed
+    to index it and split it into shards
+    """
     if not run.validate_output():
         logger.error('When outputting to stdout, exactly one output format must be selected')
         sys.exit(3)
 
-    if run.binary:
-        semgrep = Path(run.binary)
-        if not semgrep.exists() or not semgrep.is_file():
-            logger.error("Provided path to semgrep is not a valid file")
-            sys.exit(1)
-        if not os.access(semgrep, os.X_OK):
-            logger.error("Provided semgrep file is not executable")
-            sys.exit(2)
-    else:
-        semgrep = shutil.which('semgrep')
-        if semgrep is None:
-            logger.error("Unable to find semgrep. make sure it's within your PATH or specify the location directly")
-            sys.exit(3)
-    run.binary = semgrep
-
     if not run.init_from_code:
         Console().print(
             Text.assemble(*['Hint: This command can also be run by only using ', (run.to_code(), 'blue'), ]))
 
-    with tempfile.NamedTemporaryFile(delete=not run.keep_rules_file, delete_on_close=False, prefix='seamgrep-search-',
-                                     suffix='.yaml') as stream:
+    # The history is recorded from the JSON output, which is written to a temporary file if it was not requested
+    private_json = run.history and 'export_json' not in run.features
+    if private_json:
+        run.features = [*run.features, 'export_json']
+
+    async with Pipeline() as pipeline:
+        pipeline.add('database', functools.partial(open_database, load_database))
+        pipeline.add('binary', functools.partial(resolve_binary, run))
+        if run.prefilter or run.shards > 1:
+            pipeline.add('manifest', functools.partial(refresh_manifest, run.target, run.prefilter))
+        if run.prefilter:
+            pipeline.add('index', lambda files: files.identifiers, 'manifest')
+        if run.shards > 1:
+            pipeline.add('shards', lambda files: plan_shards(run.target, run.shards, run.shard_by_directory,
+                                                             files.tree()), 'manifest')
         if run.rules_file is None:
-            rules = db.table('rules')
-            result = filter_rules(rules, run.filter_config)
+            pipeline.add('version', probe_version, 'binary')
+            if run.delta is not None:
+                pipeline.add('delta', functools.partial(compute_delta, run), 'database')
+            pipeline.add('rules', functools.partial(collect_rules, run, include, exclude),
+                         'database', 'version', *(['delta'] if run.delta is not None else []))
+
+        db = await pipeline.result('database')
+        merger = None
+        prioritized = None
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=not run.keep_rules_file,
+                                         delete_on_close=False, prefix='seamgrep-search-',
+                                         suffix=f'.{run.rules_format}') as stream, \
+                tempfile.TemporaryDirectory(prefix='semgrep-search-history-') as history_dir:
+            if private_json:
+                run.private_json = Path(history_dir) / 'findings.json'
+            tiers = None
+            # The phase semgrep waits for to get its rules
+            selected = 'rules'
+            # None if a pre-generated ruleset is used
+            result = await pipeline.result('rules') if run.rules_file is None else None
+            # The rules whose findings are fixed if they are not found again, None for all rules of the ruleset file
+            ran = None
+            if result is not None:
+                # Rules dropped by the prefilter cannot match, so they count as having run
+                ran = {rule['id'] for rule in result}
+                if run.prefilter:
+                    result = await pipeline.add('prefilter', functools.partial(prefilter_rules, db), 'rules', 'index')
+                    selected = 'prefilter'
+
+                if len(result) == 0:
+                    if run.delta is not None and (await pipeline.result('delta')).stale:
+                        # Nothing has to run, but the findings of changed and removed rules are outdated
+                        DeltaMerger(run.output_files(), await pipeline.result('delta'),
+                                    {rule['id'] for rule in db.table('rules')}).drop_stale()
+                        logger.info('No changed rules have to run, removed the findings of changed and removed rules')
+                        return
+                    logger.info('No rules found matching your search criteria')
+                    return
+
+                if run.prioritized:
+                    # Every severity gets its own ruleset, written while the previous severity is running
+                    tiers = partition(result)
+                else:
+                    await pipeline.add('serialize', functools.partial(serialize_rules, run, stream), selected)
+                    selected = 'serialize'
+
+            if run.delta is not None:
+                merger = DeltaMerger(run.output_files(), await pipeline.result('delta'),
+                                     {rule['id'] for rule in db.table('rules')})
+                merger.stash()
+
+            shards = await pipeline.result('shards') if run.shards > 1 else None
+
+            async def semgrep(*_: object) -> Union[int, PrioritizedResult]:
+                if run.distribute is not None:
+                    return await coordinate(run, result, shards, load_fragments(run.rules_format))
+                if tiers is not None:
+                    return await run_prioritized(run, tiers, functools.partial(scan, shards=shards),
+                                                 load_fragments(run.rules_format))
+                return await scan(run, shards)
+
+            try:
+                dependencies = [name for name in ('binary', selected, 'shards') if name in pipeline.phases]
+                outcome = await pipeline.add('semgrep', semgrep, *dependencies)
+            except BaseException:
+                if merger is not None:
+                    merger.restore()
+                raise
+            if isinstance(outcome, PrioritizedResult):
+                prioritized = outcome
+                outcome = prioritized.rc
+            logger.debug(f'rc: {outcome}')
+
+            if merger is not None:
+                merger.merge()
+
+            await pipeline.add('outputs', lambda _: process_outputs(run, db, outcome, prioritized, ran), 'semgrep')
+            pipeline.report()
+
+            if prioritized is not None and run.fail_fast and prioritized.blocking_findings:
+                logger.error(f'Found {prioritized.blocking_findings} blocking findings')
+                sys.exit(1)
+
+            if run.watch:
+                # Within the block, so the ruleset is kept
+                await watch(run, db)
+
+
+def open_database(load_database: Callable[[], Optional[TinyDB]]) -> TinyDB:
+    db = load_database()
+    if db is None:
+        sys.exit(1)
+    return db
+
+
+def resolve_binary(run: RunConfig) -> Optional[Union[Path, str]]:
+    if run.distribute is not None and run.binary is None and shutil.which('semgrep') is None:
+        # Only the workers run semgrep
+        return None
+    run.binary = find_semgrep(run.binary)
+    return run.binary
+
+
+def probe_version(binary: Optional[Union[Path, str]]) -> Optional[str]:
+    # The version is only needed to look up the rules quarantined for it
+    if binary is None or not load_quarantine_file():
+        return None
+    return get_semgrep_version(binary)
+
+
+def compute_delta(run: RunConfig, db: TinyDB) -> RuleDelta:
+    try:
+        delta = RuleDelta.compute(db, run.delta)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    logger.info(f'Database contains {delta}')
+    return delta
+
+
+def collect_rules(run: RunConfig, include: Optional[set[str]], exclude: Optional[set[str]], db: TinyDB,
+                  version: Optional[str], delta: Optional[RuleDelta] = None) -> Optional[list[dict]]:
+    """
+    Selects the rules to run. Returns None if a pre-generated ruleset can be used instead.
+    """
+    apply_rule_patterns(run.filter_config, db, include, exclude)
+    apply_facets(run.filter_config, db)
+    apply_quarantine(run.filter_config, db, run.binary, version)
+    if run.init_from_code and run.delta is None and not run.prefilter and not run.prioritized and run.rule_shards == 1 \
+            and not run.filter_config.excluded_ids and run.filter_config.included_ids is None:
+        use_pregenerated_ruleset(run, db)
+        if run.rules_file is not None:
+            return None
+
+    result = filter_rules(db.table('rules'), run.filter_config)
+    if delta is not None:
+        changed = delta.changed
+        result = [rule for rule in result if rule['id'] in changed]
+    return result
+
+
+def serialize_rules(run: RunConfig, stream: tempfile.NamedTemporaryFile, rules: list[dict]) -> None:
+    with metrics.timer('sgs_ruleset_serialization_seconds_total', 'Time spent serializing rulesets'):
+        try:
+            write_ruleset(rules, stream, load_fragments(run.rules_format), run.rules_format)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+    metrics.inc('sgs_ruleset_rules_total', 'Number of rules written to rulesets', len(rules))
+    stream.close()
+    logger.info(f'Successfully written {len(rules)} rules to {stream.name}')
+    run.rules_file = Path(stream.name)
+
+
+def process_outputs(run: RunConfig, db: TinyDB, rc: int = 0, prioritized: Optional[PrioritizedResult] = None,
+                    ran: Optional[set[str]] = None) -> None:
+    count_findings(run)
+
+    if run.enrich:
+        enrich_outputs(run, db)
+
+    if run.history:
+        # Findings missing from an incomplete run have not been fixed
+        if not 0 <= rc < 2:
+            logger.warning(f'Not recording the findings in the history, semgrep failed with exit code {rc}')
+        elif prioritized is not None and prioritized.skipped:
+            logger.warning('Not recording the findings in the history, the tiers '
+                           f'{", ".join(prioritized.skipped)} were skipped')
+        else:
+            track_findings(run, db, ran)
+
+
+async def scan(run: RunConfig, shards: Optional[list[Shard]] = None) -> int:
+    """Runs semgrep, split into shards if requested"""
+    if run.shards > 1:
+        shards = shards if shards is not None else plan_shards(run.target, run.shards, run.shard_by_directory)
+        logger.info(f'Running semgrep in {len(shards)} shards')
+        return await run_shards(run, shards)
+    return await run_semgrep(run)
+
+
+def use_pregenerated_ruleset(run: RunConfig, db: TinyDB) -> None:
+    """Uses the ruleset generated by warm for the run configuration, if it exists"""
+    cached = DerivedCache.for_db(db).ruleset(run.to_code(), run.rules_format)
+    hit = cached is not None and cached.is_file()
+    metrics.cache('ruleset', hit=hit)
+    if hit:
+        logger.info(f'Using pre-generated ruleset {cached}')
+        run.rules_file = cached
+
+
+def count_findings(run: RunConfig) -> None:
+    outputs = run.output_files()
+    for output_format in ('json', 'sarif'):
+        file = outputs.get(output_format)
+        if file is not None and file.is_file():
+            try:
+                severities = count_severities(file, output_format)
+            except ValueError as e:
+                logger.debug(f'Unable to count the findings in {file}: {e}')
+                continue
+            for severity, count in severities.items():
+                metrics.inc('sgs_findings_total', 'Number of findings reported by semgrep', count,
+                            severity=severity)
+            return
 
-            if len(result) == 0:
-                logger.info('No rules found matching your search criteria')
-                return
 
-            write_ruleset(result, stream)
-            stream.close()
-            logger.info(f'Successfully written {len(result)} rules to {stream.name}')
-            run.rules_file = Path(stream.name)
+def enrich_outputs(run: RunConfig, db: TinyDB) -> None:
+    outputs = run.output_files()
+    if 'json' not in outputs and 'sarif' not in outputs:
+        logger.warning('Enrichment is only supported for JSON and SARIF outputs')
+        return
 
-        rc = asyncio.run(run_semgrep(run))
-        logger.debug(f'rc: {rc}')
+    with measure_time('Enriched findings in %s', logging.DEBUG):
+        index = RuleIndex.from_db(db)
+        for output_format, enrich in (('json', index.enrich_json), ('sarif', index.enrich_sarif)):
+            file = outputs.get(output_format)
+            if file is None:
+                continue
+            if not file.is_file():
+                logger.warning(f'Unable to enrich {file}, semgrep did not create the file')
+                continue
+            enrich(file)
@@ -1,8 +1,7 @@
 import argparse
-import math
 import os
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, Optional, Union
 
 import base58
 
@@ -60,10 +59,14 @@ class BitFlag:
                 values.append(feature)
         return values
 
+    def unknown(self, values: list[str]) -> list[str]:
+        return [value for value in values if value not in self._values]
+
     def build(self, values: list[str], trim: bool = False) -> bytes:
         bits = [self._values.get(value, 0) for value in values]
-        max_value = max(bits) if trim else max(self._values.values())
-        num_bytes = max(1, math.ceil(max_value / 7))
+        max_value = max(bits, default=0) if trim else max(self._values.values())
+        # Every byte holds 7 bits, so bit 7 already requires a second byte
+        num_bytes = max_value // 7 + 1
         b = []
 
         for i in range(num_bytes):
@@ -79,6 +82,35 @@ class BitFlag:
         return bytes(b)
 
 
+class NumberFlag:
+    """
+    Encodes a list of numbered values (e.g. CWE-89) as 14 bit numbers, as there are too many of them for a BitFlag
+    """
+
+    def __init__(self, prefix: str):
+        self._prefix = prefix
+
+    def _number(self, value: str) -> Optional[int]:
+        if not value.startswith(self._prefix) or not value[len(self._prefix):].isdigit():
+            return None
+        number = int(value[len(self._prefix):])
+        return number if number < 1 << 14 else None
+
+    def parse(self, group: list[int]) -> list[str]:
+        payload = [b & ~BitMapper.CONTINUE_BIT for b in group]
+        # An empty list is a single byte
+        return [f'{self._prefix}{(payload[i] << 7) + payload[i + 1]}' for i in range(0, len(payload) - 1, 2)]
+
+    def unknown(self, values: list[str]) -> list[str]:
+        return [value for value in values if self._number(value) is None]
+
+    def build(self, values: list[str], trim: bool = False) -> bytes:
+        numbers = sorted({number for number in map(self._number, values) if number is not None})
+        b = [part for number in numbers for part in (number >> 7, number & 0x7F)] or [0]
+        # All but the last byte set the continue bit
+        return bytes([byte | BitMapper.CONTINUE_BIT for byte in b[:-1]] + b[-1:])
+
+
 class RunConfig:
     _CATEGORIES = BitFlag(
         {"null": 0, "best-practice": 1, "correctness": 2, "maintainability": 3, "performance": 4, "portability": 5,
@@ -90,28 +122,63 @@ class RunConfig:
             "scala": 27, "scheme": 28, "solidity": 29, "swift": 30, "tf": 31, "ts": 32, "yaml": 33, "xml": 34, })
     _SEVERITIES = BitFlag({"null": 0, "INVENTORY": 1, "INFO": 2, "WARNING": 3, "ERROR": 4, })
     _FEATURES = BitFlag({"export_text": 0, "export_sarif": 1, "export_json": 2, })
+    _CWES = NumberFlag("CWE-")
+    _OWASP = BitFlag({f"A{i:02d}:{year}": n * 10 + i - 1 for n, year in enumerate((2017, 2021, 2025))
+                      for i in range(1, 11)})
+    _LEVELS = BitFlag({"LOW": 0, "MEDIUM": 1, "HIGH": 2, })
 
-    flag_order: list[tuple[BitFlag, Callable[['RunConfig'], list[str]]]] = [
+    flag_order: list[tuple[Union[BitFlag, NumberFlag], Callable[['RunConfig'], list[str]]]] = [
         (_CATEGORIES, lambda self: self.categories),
         (_LANGUAGES, lambda self: self.languages),
         (_SEVERITIES, lambda self: self.severities),
         (_FEATURES, lambda self: self.features),
+        (_CWES, lambda self: self.cwes),
+        (_OWASP, lambda self: self.owasp),
+        (_LEVELS, lambda self: self.confidence),
+        (_LEVELS, lambda self: self.likelihood),
+        (_LEVELS, lambda self: self.impact),
     ]
+    # The flags of the first version, later flags are only added to the code if they are set
+    REQUIRED_FLAGS = 4
 
-    def __init__(self, categories: list[str], languages: list[str], severities: list[str], features: list[str], *,
+    def __init__(self, categories: list[str], languages: list[str], severities: list[str], features: list[str],
+                 cwes: Optional[list[str]] = None, owasp: Optional[list[str]] = None,
+                 confidence: Optional[list[str]] = None, likelihood: Optional[list[str]] = None,
+                 impact: Optional[list[str]] = None, *,
                  from_code=False, rules_file: Optional[Path]=None, keep_rules_file=None):
         self.categories = categories
         self.languages = languages
         self.severities = severities
         self.features = features
+        self.cwes = cwes or []
+        self.owasp = owasp or []
+        self.confidence = confidence or []
+        self.likelihood = likelihood or []
+        self.impact = impact or []
         self.filter_config = FilterConfig.from_config(self)
         self.binary = None
         self.output: Path = None
+        # The JSON output if it is only written for the history, instead of next to the other outputs
+        self.private_json: Optional[Path] = None
         self.target: Path = Path('.').absolute()
         self.init_from_code = from_code
         self.rules_file = rules_file
         self.keep_rules_file = keep_rules_file
-        
+        self.enrich = False
+        self.delta: Optional[str] = None
+        self.shards = 1
+        self.rules_format = 'yaml'
+        self.shard_by_directory = False
+        self.prefilter = False
+        self.prioritized = False
+        self.fail_fast = False
+        self.history = False
+        self.new_only = False
+        self.distribute: Optional[str] = None
+        self.rule_shards = 1
+        self.lease = 60.0
+        self.watch = False
+
     @staticmethod
     def from_rules_file(file: Path, features: list[str]) -> 'RunConfig':
         if not file.is_file():
@@ -150,31 +217,97 @@ class RunConfig:
             config.target = Path(args.target)
         if config.keep_rules_file is None:
             config.keep_rules_file = args.keep_rules_file
+        config.enrich = args.enrich
+        config.delta = args.delta
+        if config.delta is not None and args.rules:
+            raise ValueError('Running only changed rules is not possible with a pre-generated set of rules')
+        if (args.rule or args.exclude_rule) and args.rules:
+            raise ValueError('Selecting rules by id is not possible with a pre-generated set of rules')
+        if args.prefilter and args.rules:
+            raise ValueError('Excluding rules that cannot match is not possible with a pre-generated set of rules')
+        config.prefilter = args.prefilter
+        if args.fail_fast and not args.prioritized:
+            raise ValueError('--fail-fast requires --prioritized')
+        if args.prioritized and args.rules:
+            raise ValueError('Running rules by severity is not possible with a pre-generated set of rules')
+        config.prioritized = args.prioritized
+        config.fail_fast = args.fail_fast
+        if args.new_only and not args.history:
+            raise ValueError('--new-only requires --history')
+        config.history = args.history
+        config.new_only = args.new_only
+        if args.shards < 1:
+            raise ValueError('The number of shards must be at least 1')
+        config.shards = args.shards
+        if args.rule_shards < 1:
+            raise ValueError('The number of rule shards must be at least 1')
+        if args.rule_shards > 1 and not args.distribute:
+            raise ValueError('--rule-shards requires --distribute')
+        if args.rule_shards > 1 and args.rules:
+            raise ValueError('Splitting the rules is not possible with a pre-generated set of rules')
+        if args.distribute and not config.features:
+            raise ValueError('--distribute requires at least one of --text, --json and --sarif')
+        if args.distribute and args.prioritized:
+            raise ValueError('Running rules by severity is not possible with --distribute')
+        if args.lease <= 0:
+            raise ValueError('The lease must be longer than 0 seconds')
+        if args.watch and (args.distribute or args.prioritized or args.delta or args.prefilter):
+            raise ValueError('--watch is not possible with --distribute, --prioritized, --delta or --prefilter')
+        if args.watch and (args.output == '-' or not {'export_json', 'export_sarif'} & set(config.features)):
+            raise ValueError('--watch requires a JSON or SARIF output file')
+        if args.watch and config.target.is_file():
+            # Only directories are watched
+            raise ValueError('--watch requires a directory as target')
+        config.watch = args.watch
+        config.distribute = args.distribute
+        config.rule_shards = args.rule_shards
+        config.lease = args.lease
+        config.shard_by_directory = args.shard_by_directory
+        config.rules_format = args.rules_format
 
         return config
 
     @staticmethod
     def from_config(config: FilterConfig, features: list[str]):
-        return RunConfig(categories=config.categories or [], languages=config.languages or [],
-            severities=config.severities or [], features=features, )
+        run = RunConfig(categories=config.categories or [], languages=config.languages or [],
+            severities=config.severities or [], features=features,
+            cwes=sorted(config.cwes or []), owasp=sorted(config.owasp or []),
+            confidence=sorted(config.confidence or []), likelihood=sorted(config.likelihood or []),
+            impact=sorted(config.impact or []), )
+        for flag, values in RunConfig.flag_order[RunConfig.REQUIRED_FLAGS:]:
+            unknown = flag.unknown(values(run))
+            if unknown:
+                raise ValueError(f'Unable to filter for {", ".join(unknown)}')
+        return run
 
     def to_code(self) -> str:
-        b = b''.join(flag[0].build(flag[1](self)) for i, flag in enumerate(RunConfig.flag_order))
-        return base58.b58encode(b).decode('ascii')
+        groups = [flag[0].build(flag[1](self)) for i, flag in enumerate(RunConfig.flag_order)]
+        # Unused filters are left out, so the codes of configurations without them remain the same
+        while len(groups) > RunConfig.REQUIRED_FLAGS and not RunConfig.flag_order[len(groups) - 1][1](self):
+            groups.pop()
+        return base58.b58encode(b''.join(groups)).decode('ascii')
 
     def validate_output(self) -> bool:
         if self.output != '-':
             return True
         return len(self.output_params()) == 1
 
-    def output_params(self) -> list[str]:
-        params = []
+    def output_files(self, base: Optional[Path] = None) -> dict[str, Path]:
+        private_json = self.private_json if base is None else None
+        base = base or self.output
+        files = {}
         if 'export_text' in self.features:
-            params.extend(['--text-output', f'{self.output.with_suffix(".txt")}', ])
+            files['text'] = base.with_suffix('.txt')
         if 'export_json' in self.features:
-            params.extend(['--json-output', f'{self.output.with_suffix(".json")}', ])
+            files['json'] = private_json or base.with_suffix('.json')
         if 'export_sarif' in self.features:
-            params.extend(['--sarif-output', f'{self.output.with_suffix(".sarif")}', ])
+            files['sarif'] = base.with_suffix('.sarif')
+        return files
+
+    def output_params(self, base: Optional[Path] = None) -> list[str]:
+        params = []
+        for output_format, file in self.output_files(base).items():
+            params.extend([f'--{output_format}-output', f'{file}', ])
         return params
 
     def __str__(self):
@@ -16,15 +16,23 @@
 
 from __future__ import annotations
 
+import io
 import logging
+import shutil
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional, Callable, TYPE_CHECKING
 
 from tinydb import Query, TinyDB
+from tinydb.queries import QueryInstance
 
 from semgrep_search.utils import fix_languages, logger, write_ruleset
+from semgrep_search.cache import load_fragments
+from semgrep_search.facets import FACETS, apply_facets, normalize_values
+from semgrep_search.metrics import metrics
+from semgrep_search.quarantine import apply_quarantine
+from semgrep_search.ruleids import apply_rule_patterns
 
 if TYPE_CHECKING:
     import argparse
@@ -33,6 +41,9 @@ if TYPE_CHECKING:
 
 LOG = logging.getLogger(__name__)
 
+# The filters of a FilterConfig that select rules by their attributes, in the order they are described in
+FILTER_NAMES = ('languages', 'categories', 'severities', 'origins', *FACETS)
+
 
 def get_set_from_arg(arg: Optional[list[str]]) -> Optional[set[str]]:
     if arg is None:
@@ -45,6 +56,28 @@ def get_set_from_arg(arg: Optional[list[str]]) -> Optional[set[str]]:
     return result
 
 
+def read_patterns(arg: Optional[list[str]]) -> Optional[set[str]]:
+    """
+    Collects the rule ids and glob patterns of an argument, reading arguments starting with @ from a file
+    (one pattern per line, lines starting with # are ignored)
+    """
+    values = get_set_from_arg(arg)
+    if values is None:
+        return None
+    patterns = set()
+    for value in values:
+        if not value.startswith('@'):
+            patterns.add(value)
+            continue
+        try:
+            with Path(value[1:]).expanduser().open('r', encoding='utf-8') as stream:
+                patterns |= {line.strip() for line in stream if line.strip() and not line.lstrip().startswith('#')}
+        except OSError as e:
+            logger.error(f'Unable to read rule ids from {value[1:]}: {e}')
+            sys.exit(1)
+    return patterns
+
+
 @dataclass
 class FilterConfig:
     languages: Optional[set[str]]
@@ -52,6 +85,15 @@ class FilterConfig:
     severities: Optional[set[str]]
     origins: Optional[set[str]]
     include_empty: bool
+    excluded_ids: Optional[set[str]] = field(default=None)
+    included_ids: Optional[set[str]] = field(default=None)
+    cwes: Optional[set[str]] = field(default=None)
+    owasp: Optional[set[str]] = field(default=None)
+    confidence: Optional[set[str]] = field(default=None)
+    likelihood: Optional[set[str]] = field(default=None)
+    impact: Optional[set[str]] = field(default=None)
+    # The ids of the rules matching the metadata filters, resolved by apply_facets
+    facet_ids: Optional[set[str]] = field(default=None)
 
     @staticmethod
     def from_args(args: argparse.Namespace) -> 'FilterConfig':
@@ -65,12 +107,15 @@ class FilterConfig:
 
         origins = get_set_from_arg(args.origin)
 
+        facets = {facet: get_set_from_arg(getattr(args, facet)) for facet in FACETS}
+
         return FilterConfig(
             include_empty=args.include_empty,
             languages=languages,
             categories=categories,
             severities=severities,
             origins=origins,
+            **{facet: normalize_values(facet, values) if values else None for facet, values in facets.items()},
         )
 
     @staticmethod
@@ -87,8 +132,42 @@ class FilterConfig:
             categories=categories if len(categories) > 0 else None,
             severities=severities if len(severities) > 0 else None,
             origins=None,
+            **{facet: set(getattr(config, facet)) or None for facet in FACETS},
         )
 
+    @staticmethod
+    def parse(spec: str) -> 'FilterConfig':
+        """
+        Parses a filter specification as returned by describe(), e.g. languages=python,js;categories=security
+        """
+        filters: dict[str, Optional[set[str]]] = dict.fromkeys(FILTER_NAMES)
+        include_empty = False
+        for part in filter(None, (part.strip() for part in spec.split(';'))):
+            name, separator, value = part.partition('=')
+            name = name.strip()
+            if not separator and name in ('include_empty', 'all'):
+                include_empty |= name == 'include_empty'
+                continue
+            if name not in FILTER_NAMES:
+                raise ValueError(f'Unknown filter {name}')
+            filters[name] = {value.strip() for value in value.split(',') if value.strip()}
+        if filters['languages']:
+            filters['languages'] = fix_languages(filters['languages'])
+        for facet in FACETS:
+            if filters[facet]:
+                filters[facet] = normalize_values(facet, filters[facet])
+        return FilterConfig(include_empty=include_empty, **filters)
+
+    def describe(self) -> str:
+        parts = []
+        for name in FILTER_NAMES:
+            values = getattr(self, name)
+            if values is not None:
+                parts.append(f'{name}={",".join(sorted(values))}')
+        if self.include_empty:
+            parts.append('include_empty')
+        return ';'.join(parts) or 'all'
+
 
 def filter_rule_by_languages(config: FilterConfig) -> Callable[[list[str]], bool]:
     def filter_fn(langs: list[str]) -> bool:
@@ -98,7 +177,11 @@ def filter_rule_by_languages(config: FilterConfig) -> Callable[[list[str]], bool
     return filter_fn
 
 
-def filter_rules(rules: Table, config: FilterConfig) -> list[dict]:
+def build_query(config: FilterConfig) -> QueryInstance:
+    """
+    Builds the query for all filters of the config that depend on the attributes of a rule,
+    i.e. all but the rule ids and the metadata filters
+    """
     Rule = Query()  # noqa: N806 - Better readability
 
     q = Rule.id.exists()
@@ -122,12 +205,37 @@ def filter_rules(rules: Table, config: FilterConfig) -> list[dict]:
     if config.origins is not None:
         q &= Rule.source.one_of(config.origins)
 
-    return rules.search(q)
+    return q
+
+
+def filter_rules(rules: Table, config: FilterConfig) -> list[dict]:
+    Rule = Query()  # noqa: N806 - Better readability
+
+    q = build_query(config)
+
+    if config.included_ids is not None:
+        included_ids = config.included_ids
+        q &= Rule.id.test(lambda rule_id: rule_id in included_ids)
+
+    if config.excluded_ids:
+        excluded_ids = config.excluded_ids
+        q &= Rule.id.test(lambda rule_id: rule_id not in excluded_ids)
+
+    if config.facet_ids is not None:
+        facet_ids = config.facet_ids
+        q &= Rule.id.test(lambda rule_id: rule_id in facet_ids)
+
+    result = rules.search(q)
+    metrics.gauge('sgs_rules_selected', len(result), 'Number of rules matching a filter', filter=config.describe())
+    return result
 
 
 def search(args: argparse.Namespace, db: TinyDB) -> None:
     rules = db.table('rules')
     config = FilterConfig.from_args(args)
+    apply_rule_patterns(config, db, read_patterns(args.rule), read_patterns(args.exclude_rule))
+    apply_facets(config, db)
+    apply_quarantine(config, db, shutil.which('semgrep'))
 
     result = filter_rules(rules, config)
 
@@ -135,14 +243,26 @@ def search(args: argparse.Namespace, db: TinyDB) -> None:
         logger.info('No rules found matching your search criteria')
         return
 
-    if args.output == '-':
-        path = None
-        stream = sys.stdout
+    path = None if args.output == '-' else Path(args.output)
+    ruleset_format = args.format
+    if ruleset_format is None:
+        ruleset_format = 'json' if path is not None and path.suffix == '.json' else 'yaml'
+
+    # Rendered before the output is opened, so a rule that cannot be rendered does not leave a truncated file behind
+    ruleset = io.StringIO()
+    with metrics.timer('sgs_ruleset_serialization_seconds_total', 'Time spent serializing rulesets'):
+        try:
+            write_ruleset(result, ruleset, load_fragments(ruleset_format), ruleset_format)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+    metrics.inc('sgs_ruleset_rules_total', 'Number of rules written to rulesets', len(result))
+
+    if path is None:
+        sys.stdout.write(ruleset.getvalue())
     else:
-        path = Path(args.output)
-        stream = path.open('w+')
-
-    write_ruleset(result, stream)
+        with path.open('w', encoding='utf-8') as stream:
+            stream.write(ruleset.getvalue())
 
     if path is not None:
         logger.info(f'Successfully written {len(result)} rules to {path.absolute()}')
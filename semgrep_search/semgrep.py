@@ -1,12 +1,21 @@
+from __future__ import annotations
+
 import asyncio
 import functools
+import os
+import shutil
 import subprocess
 import sys
 from asyncio import StreamReader
+from pathlib import Path
+from typing import Optional, Union, TYPE_CHECKING
 
-from semgrep_search.runconfig import RunConfig
+from semgrep_search.metrics import metrics
 from semgrep_search.utils import logger
 
+if TYPE_CHECKING:
+    from semgrep_search.runconfig import RunConfig
+
 
 class MyProtocol(asyncio.subprocess.SubprocessStreamProtocol):
     def __init__(self, stdout: StreamReader, stderr: StreamReader, limit, loop):
@@ -41,13 +50,48 @@ class MyProtocol(asyncio.subprocess.SubprocessStreamProtocol):
                 self._stderr.feed_eof()
 
 
-async def run_semgrep(run: RunConfig):
+def find_semgrep(binary: Optional[str]) -> Union[Path, str]:
+    if binary:
+        semgrep = Path(binary)
+        if not semgrep.exists() or not semgrep.is_file():
+            logger.error("Provided path to semgrep is not a valid file")
+            sys.exit(1)
+        if not os.access(semgrep, os.X_OK):
+            logger.error("Provided semgrep file is not executable")
+            sys.exit(2)
+        # semgrep is run within the target directory, so a relative path would no longer be valid
+        semgrep = semgrep.absolute()
+    else:
+        semgrep = shutil.which('semgrep')
+        if semgrep is None:
+            logger.error("Unable to find semgrep. make sure it's within your PATH or specify the location directly")
+            sys.exit(3)
+    return semgrep
+
+
+def get_semgrep_version(binary: Union[Path, str]) -> Optional[str]:
+    try:
+        proc = subprocess.run([binary, '--version'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug(f'Unable to determine the version of semgrep: {e}')
+        return None
+    return proc.stdout.strip().splitlines()[-1] if proc.stdout.strip() else None
+
+
+async def run_semgrep(run: RunConfig, *, targets: Optional[list[str]] = None, output: Optional[Path] = None,
+                      extra_args: Optional[list[str]] = None):
+    """
+    Runs semgrep within the target directory, optionally only against the given paths (relative to the target)
+    and writing the outputs to a different base filename
+    """
     args = [
         # 'echo',
         run.binary,
         '--disable-version-check', '--metrics=off', '--disable-nosem',
         '--config', str(run.rules_file.absolute()),
-        *run.output_params(),
+        *run.output_params(output),
+        *(extra_args or []),
+        *(targets or []),
     ]
 
     loop = asyncio.get_event_loop()
@@ -59,19 +103,22 @@ async def run_semgrep(run: RunConfig):
         async for line in src:
             dst.write(line.decode())
 
-    transport, protocol = await loop.subprocess_exec(
-        protocol_factory,
-        *args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        cwd=run.target,
-    )
+    with metrics.timer('sgs_semgrep_duration_seconds_total', 'Wall time spent running semgrep'):
+        transport, protocol = await loop.subprocess_exec(
+            protocol_factory,
+            *args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=run.target,
+        )
 
-    proc = asyncio.subprocess.Process(transport, protocol, loop)
+        proc = asyncio.subprocess.Process(transport, protocol, loop)
 
-    (out, err), _, _ = await asyncio.gather(
-        proc.communicate(), log_stream(stdout, sys.stdout), log_stream(stderr, sys.stderr)
-    )
+        (out, err), _, _ = await asyncio.gather(
+            proc.communicate(), log_stream(stdout, sys.stdout), log_stream(stderr, sys.stderr)
+        )
+    metrics.inc('sgs_semgrep_runs_total', 'Number of semgrep runs by exit code', exit_code=str(proc.returncode))
+    metrics.gauge('sgs_semgrep_exit_code', proc.returncode, 'Exit code of the last semgrep run')
     if proc.returncode > 0:
         logger.error(f'semgrep returned non-zero exit code: {proc.returncode}')
     return proc.returncode
@@ -0,0 +1,109 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+from semgrep_search.results import merge_outputs
+from semgrep_search.semgrep import run_semgrep
+from semgrep_search.targets import DirectoryTree
+from semgrep_search.utils import logger
+
+if TYPE_CHECKING:
+    from semgrep_search.runconfig import RunConfig
+
+# Stop splitting directories once there are this many units per shard, the balance would hardly improve
+MAX_UNITS_PER_SHARD = 64
+
+
+@dataclass(order=True)
+class Shard:
+    size: int
+    index: int
+    paths: list[str] = field(default_factory=list, compare=False)
+
+
+def plan_units(tree: DirectoryTree, count: int, by_directory: bool) -> list[tuple[int, str]]:
+    """
+    Breaks the target into (size, path) units small enough to be distributed evenly across count shards.
+    Directories are only split if they are too large, to keep files of the same directory within the same shard.
+    """
+    units = [(-size, path, is_dir) for size, path, is_dir in tree.children('')]
+    if by_directory:
+        return [(-size, path) for size, path, _ in units]
+
+    heapq.heapify(units)
+    limit = tree.size('') / count
+    result = []
+    while units and len(units) + len(result) < count * MAX_UNITS_PER_SHARD:
+        size, path, is_dir = heapq.heappop(units)
+        if not is_dir:
+            result.append((-size, path))
+            continue
+        if -size <= limit:
+            # The largest unit is small enough, so are all remaining ones
+            result.append((-size, path))
+            break
+        for child in tree.children(path):
+            heapq.heappush(units, (-child[0], child[1], child[2]))
+    return result + [(-size, path) for size, path, _ in units]
+
+
+def plan_shards(target: Path, count: int, by_directory: bool, tree: Optional[DirectoryTree] = None) -> list[Shard]:
+    tree = tree if tree is not None else DirectoryTree.scan(target)
+    shards = [Shard(0, i) for i in range(count)]
+    # Assign the largest units first, always to the shard with the least amount of bytes
+    for size, path in sorted(plan_units(tree, count, by_directory), reverse=True):
+        shard = heapq.heappop(shards)
+        shard.paths.append(path)
+        shard.size += size
+        heapq.heappush(shards, shard)
+    return sorted((shard for shard in shards if shard.paths), key=lambda shard: shard.index)
+
+
+async def run_shards(run: RunConfig, shards: list[Shard]) -> int:
+    if not shards:
+        # There is nothing to split up, e.g. the target is empty
+        return await run_semgrep(run)
+    # Share the available cores between all semgrep processes instead of letting each of them use all of them
+    jobs = max(1, (os.cpu_count() or 1) // len(shards))
+    outputs = run.output_files()
+
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-shards-') as tmp:
+        bases = [Path(tmp) / f'shard-{shard.index}' for shard in shards]
+        for shard in shards:
+            logger.debug(f'Shard {shard.index}: {len(shard.paths)} paths with {shard.size} bytes')
+
+        rcs = await asyncio.gather(*(
+            run_semgrep(run, targets=shard.paths, output=base, extra_args=['--jobs', str(jobs)])
+            for shard, base in zip(shards, bases)
+        ))
+
+        for output_format, destination in outputs.items():
+            files = [run.output_files(base)[output_format] for base in bases]
+            missing = [file for file in files if not file.is_file()]
+            if missing:
+                logger.warning(f'{len(missing)} shards did not create a {output_format} output')
+            merge_outputs(output_format, [file for file in files if file.is_file()], destination)
+
+    return max(rcs)
@@ -0,0 +1,122 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Mapping, Optional
+
+IGNORED_DIRECTORIES = {'.git', '.hg', '.svn'}
+# Skipped by semgrep unless the target has a .semgrepignore of its own. They are still part of a shard,
+# but do not add to its size.
+SEMGREP_IGNORED_DIRECTORIES = {'node_modules', 'build', 'dist', 'vendor', '.env', '.venv', '.tox', '.npm', '.yarn',
+                               '.semgrep', '.semgrep_logs'}
+
+
+def join(parent: str, name: str) -> str:
+    return f'{parent}/{name}' if parent else name
+
+
+class DirectoryTree:
+    """
+    Total size of every directory of a target. Paths are relative to the target, the target itself is ''.
+    Files are not kept in memory but listed again once a directory is split up, unless the tree was built from
+    the sizes of all files.
+    """
+
+    def __init__(self, root: Path, sizes: dict[str, int], subdirectories: dict[str, list[str]],
+                 files: Optional[dict[str, list[tuple[int, str]]]] = None) -> None:
+        self.root = root
+        self._sizes = sizes
+        self._subdirectories = subdirectories
+        self._files = files
+
+    @staticmethod
+    def scan(root: Path) -> 'DirectoryTree':
+        sizes: dict[str, int] = {}
+        subdirectories: dict[str, list[str]] = {}
+        order = []
+        for current, dirs, files in os.walk(root):
+            skipped = [name for name in dirs if name in SEMGREP_IGNORED_DIRECTORIES]
+            dirs[:] = [name for name in dirs if name not in IGNORED_DIRECTORIES and name not in skipped]
+            path = Path(current).relative_to(root).as_posix()
+            path = '' if path == '.' else path
+            order.append(path)
+            subdirectories[path] = [join(path, name) for name in dirs + skipped]
+            for name in skipped:
+                sizes[join(path, name)] = 0
+                subdirectories[join(path, name)] = []
+            size = 0
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(current, name)).st_size
+                except OSError:
+                    continue
+            sizes[path] = size
+
+        # os.walk lists parents before their children, so accumulate in reverse
+        for path in reversed(order):
+            sizes[path] += sum(sizes.get(child, 0) for child in subdirectories[path])
+        return DirectoryTree(root, sizes, subdirectories)
+
+    @staticmethod
+    def from_files(root: Path, files: Mapping[str, int]) -> 'DirectoryTree':
+        """Builds the tree from the size of every file (e.g. of a manifest), without accessing the file system"""
+        sizes: dict[str, int] = {'': 0}
+        subdirectories: dict[str, list[str]] = {'': []}
+        listed: dict[str, list[tuple[int, str]]] = {}
+        for path, size in files.items():
+            parts = path.split('/')
+            skipped = next((i for i, part in enumerate(parts[:-1]) if part in SEMGREP_IGNORED_DIRECTORIES), None)
+            if skipped is None:
+                directory = path.rpartition('/')[0]
+                listed.setdefault(directory, []).append((size, path))
+            else:
+                # Only the skipped directory itself is part of the tree
+                directory = '/'.join(parts[:skipped + 1])
+                size = 0
+            # Adds the size to all parents, registering the directories that were not seen before
+            child = None
+            child_is_new = False
+            while True:
+                is_new = directory not in sizes
+                if is_new:
+                    sizes[directory] = 0
+                    subdirectories[directory] = []
+                if child_is_new:
+                    subdirectories[directory].append(child)
+                sizes[directory] += size
+                if not directory:
+                    break
+                child, child_is_new = directory, is_new
+                directory = directory.rpartition('/')[0]
+        return DirectoryTree(root, sizes, subdirectories, listed)
+
+    def size(self, path: str) -> int:
+        return self._sizes.get(path, 0)
+
+    def children(self, path: str) -> list[tuple[int, str, bool]]:
+        """Lists (size, path, is_dir) of all files and directories within the directory path"""
+        result = [(self.size(child), child, True) for child in self._subdirectories.get(path, [])]
+        if self._files is not None:
+            result.extend((size, file, False) for size, file in self._files.get(path, []))
+            return result
+        with os.scandir(self.root / path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    result.append((entry.stat(follow_symlinks=False).st_size, join(path, entry.name), False))
+        return result
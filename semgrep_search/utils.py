@@ -17,19 +17,24 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
+import io
+import json
 import logging
 import os
 import sys
+import tempfile
 from contextlib import contextmanager
 from importlib import metadata
 from importlib.metadata import PackageNotFoundError
 from pathlib import Path
-from typing import Union, Tuple, Callable, ContextManager, TextIO, TYPE_CHECKING, Optional
+from typing import Any, Union, Tuple, Callable, ContextManager, TextIO, TYPE_CHECKING, Optional, Iterator, Mapping
 
 import tomli
 from babel.dates import format_datetime
 from rich.text import Text
 from ruamel.yaml import YAML, CommentedSeq, CommentedMap
+from ruamel.yaml.constructor import SafeConstructor
 from semver import Version
 
 from semgrep_search.const import LANGUAGE_ALIASES
@@ -85,32 +90,106 @@ def measure_time(output: str, level: int = logging.INFO) -> Callable[..., Contex
     logger.log(level, output, human_readable(elapsed_time))
 
 
+@contextmanager
+def atomic_write(path: Path) -> Iterator[TextIO]:
+    """
+    Opens a temporary file next to path for writing, which replaces path once the block exits without an error
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as stream:
+            yield stream
+        # mkstemp only grants access to the owner, keep the permissions a regular file would have gotten instead
+        if path.exists():
+            mode = path.stat().st_mode & 0o777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        Path(tmp).chmod(mode)
+        Path(tmp).replace(path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
 yaml = YAML(typ='rt')
 
 
-def write_ruleset(rules: list[dict], stream: TextIO) -> None:
-    data = CommentedSeq()
-    for rule in rules:
-        rule_data: CommentedMap = yaml.load(rule['content'])
-        rule_data.setdefault('metadata', CommentedMap())
+class _JsonConstructor(SafeConstructor):
+    """Keeps timestamps as they are written, JSON has no type for them"""
+
 
-        # Add detailed information
-        rule_data['metadata'].setdefault('semgrep-search', CommentedMap())
-        # rule_data['metadata']['semgrep-search']['']
+_JsonConstructor.add_constructor('tag:yaml.org,2002:timestamp', SafeConstructor.construct_yaml_str)
 
-        # Add origin to metadata
-        rule_data['metadata'].setdefault('semgrep.dev', CommentedMap())
-        rule_data['metadata']['semgrep.dev'].setdefault('rule', CommentedMap())
-        rule_data['metadata']['semgrep.dev']['rule']['origin'] = rule['source']
+# Resolves scalars by YAML 1.2 like the round-trip loader (and semgrep), unlike the YAML 1.1 resolver of PyYAML
+json_yaml = YAML(typ='safe', pure=True)
+json_yaml.Constructor = _JsonConstructor
 
-        data.append(rule_data)
-    output = CommentedMap({'rules': data})
-    output.yaml_set_comment_before_after_key(
-        'rules',
-        before=f'Generated on {format_datetime(datetime.datetime.now())} with semgrep-search '
-               f'(https://github.com/hnzlmnn/semgrep-search) v{str(get_version())}'
-    )
-    yaml.dump(output, stream)
+
+def _add_metadata(rule_data: dict, rule: dict, mapping: type) -> dict:
+    rule_data.setdefault('metadata', mapping())
+
+    # Add detailed information
+    rule_data['metadata'].setdefault('semgrep-search', mapping())
+    # rule_data['metadata']['semgrep-search']['']
+
+    # Add origin to metadata
+    rule_data['metadata'].setdefault('semgrep.dev', mapping())
+    rule_data['metadata']['semgrep.dev'].setdefault('rule', mapping())
+    rule_data['metadata']['semgrep.dev']['rule']['origin'] = rule['source']
+    return rule_data
+
+
+def render_rule(rule: dict, ruleset_format: str = 'yaml') -> str:
+    """
+    Renders a single rule as an item of the rules list of a ruleset.
+    Raises a ValueError if the rule contains values JSON cannot represent.
+    """
+    if ruleset_format == 'json':
+        # The round-trip loader is only required to keep comments and formatting, which JSON has no use for
+        rule_data = _add_metadata(json_yaml.load(rule['content']), rule, dict)
+        try:
+            return json.dumps(rule_data, allow_nan=False)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Rule {rule["id"]} cannot be rendered as JSON, use the YAML format instead: {e}') from e
+
+    rule_data: CommentedMap = _add_metadata(yaml.load(rule['content']), rule, CommentedMap)
+    stream = io.StringIO()
+    yaml.dump(CommentedSeq([rule_data]), stream)
+    return stream.getvalue()
+
+
+def write_ruleset(rules: list[dict], stream: TextIO, fragments: Optional[Mapping[Any, str]] = None,
+                  ruleset_format: str = 'yaml', key: Optional[Callable[[dict], Any]] = None) -> None:
+    """
+    Writes the rules as a single ruleset. Rules found in fragments (by their hash, or by key if provided)
+    are not rendered again.
+    """
+    key = key or hash_rule
+
+    def fragment(rule: dict) -> str:
+        cached = fragments.get(key(rule)) if fragments is not None else None
+        return cached if cached is not None else render_rule(rule, ruleset_format)
+
+    if ruleset_format == 'json':
+        stream.write('{"rules": [')
+        for i, rule in enumerate(rules):
+            if i > 0:
+                stream.write(',\n')
+            stream.write(fragment(rule))
+        stream.write(']}\n')
+        return
+
+    stream.write(f'# Generated on {format_datetime(datetime.datetime.now())} with semgrep-search '
+                 f'(https://github.com/hnzlmnn/semgrep-search) v{str(get_version())}\n')
+    if len(rules) == 0:
+        stream.write('rules: []\n')
+        return
+    stream.write('rules:\n')
+    for rule in rules:
+        stream.write(fragment(rule))
 
 
 def get_metadata(db: TinyDB) -> Optional[dict]:
@@ -138,6 +217,29 @@ def get_metadata(db: TinyDB) -> Optional[dict]:
         return None
 
 
+def get_commit(db: TinyDB) -> Optional[str]:
+    meta = get_metadata(db)
+    return meta['commit'] if meta else None
+
+
+def get_cache_key(db: TinyDB) -> Optional[str]:
+    """
+    Identifies the rules of the database: the commit of the database and, if local rules were ingested, their version
+    """
+    commit = get_commit(db)
+    metadata = db.table('meta').all()
+    local = metadata[0].get('local') if metadata else None
+    if commit is None or not local or not local.get('digest'):
+        return commit
+    return f'{commit}+local.{local["digest"][:12]}'
+
+
+def hash_rule(rule: dict) -> str:
+    # The origin ends up in the generated ruleset, so a changed origin is a changed rule as well
+    data = json.dumps([rule.get('content'), rule.get('source')])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
 def print_verbose_info(meta: dict) -> Text:
     info = ['Database was created ']
 
@@ -0,0 +1,161 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Union, TYPE_CHECKING
+
+from semgrep_search.quarantine import store_quarantine
+from semgrep_search.facets import apply_facets
+from semgrep_search.ruleids import apply_rule_patterns
+from semgrep_search.search import FilterConfig, filter_rules, read_patterns
+from semgrep_search.semgrep import find_semgrep, get_semgrep_version
+from semgrep_search.utils import get_commit, logger, measure_time, write_ruleset
+
+if TYPE_CHECKING:
+    import argparse
+    from tinydb import TinyDB
+
+
+# Seconds after which a semgrep process validating a batch is killed, its rules are assumed to hang semgrep
+BATCH_TIMEOUT = 600
+
+
+def _names_rule(error: dict, ruleset: Path) -> bool:
+    """Whether a semgrep error is caused by a rule, rather than by the binary, the network or the target"""
+    if error.get('rule_id') or 'rule' in str(error.get('type', '')).lower():
+        return True
+    return any(span.get('file') == str(ruleset) for span in error.get('spans') or [])
+
+
+def check_batch(binary: Union[Path, str], ruleset: Path, target: Path) -> bool:
+    """
+    Returns whether all rules of the batch are valid.
+    Raises a RuntimeError if semgrep failed for a reason that no rule of the batch is responsible for.
+    """
+    try:
+        proc = subprocess.run([
+            binary,
+            '--disable-version-check', '--metrics=off', '--json', '--quiet',
+            '--config', str(ruleset),
+            str(target),
+        ], capture_output=True, text=True, timeout=BATCH_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        logger.debug(f'semgrep did not finish validating {ruleset} within {BATCH_TIMEOUT} seconds')
+        return False
+    except OSError as e:
+        raise RuntimeError(f'Unable to run semgrep: {e}') from e
+    finally:
+        ruleset.unlink(missing_ok=True)
+
+    try:
+        errors = json.loads(proc.stdout).get('errors', [])
+    except (ValueError, AttributeError):
+        errors = []
+    errors = [error for error in errors if isinstance(error, dict) and error.get('level') == 'error']
+    if proc.returncode == 0 and not errors:
+        return True
+    if any(_names_rule(error, ruleset) for error in errors):
+        return False
+    details = '; '.join(str(error.get('message', '')).strip() for error in errors) or proc.stderr.strip()
+    raise RuntimeError(f'semgrep failed with exit code {proc.returncode}: {details or "no error reported"}')
+
+
+def validate_rules(binary: Union[Path, str], rules: list[dict], jobs: int, batch_size: int) -> set[str]:
+    """
+    Runs semgrep with batches of rules against an empty directory in parallel.
+    Failing batches are split in half until the failing rules are isolated, unless semgrep failed for another reason.
+    """
+    failed = set()
+    pending: dict[Future, list[dict]] = {}
+
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-validate-') as workdir, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        target = Path(workdir) / 'target'
+        target.mkdir()
+
+        def submit(batch: list[dict]) -> None:
+            # The rulesets are written here, as the YAML dumper must not be shared between threads
+            with tempfile.NamedTemporaryFile('w', dir=workdir, suffix='.yaml', delete=False) as stream:
+                write_ruleset(batch, stream)
+            pending[executor.submit(check_batch, binary, Path(stream.name), target)] = batch
+
+        for start in range(0, len(rules), batch_size):
+            submit(rules[start:start + batch_size])
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    valid = future.result()
+                except RuntimeError:
+                    # Every other batch would fail the same way
+                    for other in pending:
+                        other.cancel()
+                    raise
+                if valid:
+                    continue
+                if len(batch) == 1:
+                    logger.debug(f'Rule {batch[0]["id"]} failed to validate')
+                    failed.add(batch[0]['id'])
+                    continue
+                middle = len(batch) // 2
+                submit(batch[:middle])
+                submit(batch[middle:])
+    return failed
+
+
+def validate(args: argparse.Namespace, db: TinyDB) -> None:
+    commit = get_commit(db)
+    if commit is None:
+        logger.error('Database does not specify a commit, unable to store a quarantine list')
+        sys.exit(1)
+
+    binary = find_semgrep(args.binary)
+    version = get_semgrep_version(binary)
+    if version is None:
+        logger.error('Unable to determine the version of semgrep')
+        sys.exit(1)
+
+    config = FilterConfig.from_args(args)
+    apply_rule_patterns(config, db, read_patterns(args.rule), read_patterns(args.exclude_rule))
+    apply_facets(config, db)
+    rules = filter_rules(db.table('rules'), config)
+    if len(rules) == 0:
+        logger.info('No rules found matching your search criteria')
+        return
+
+    logger.info(f'Validating {len(rules)} rules using semgrep {version}')
+    with measure_time('Validated rules in %s', logging.INFO):
+        try:
+            failed = validate_rules(binary, rules, max(1, args.jobs), max(1, args.batch_size))
+        except RuntimeError as e:
+            logger.error(f'Unable to validate the rules, no quarantine list was stored: {e}')
+            sys.exit(1)
+
+    quarantined = store_quarantine(commit, version, {rule['id'] for rule in rules}, failed)
+    for rule_id in sorted(failed):
+        logger.warning(f'Quarantined {rule_id}')
+    logger.info(f'{len(failed)} of {len(rules)} rules failed to validate, '
+                f'{len(quarantined)} rules are quarantined for semgrep {version} and database {commit}')
@@ -0,0 +1,125 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import compileall
+import importlib.util
+import logging
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from semgrep_search.cache import DerivedCache, load_fragments, update_fragments
+from semgrep_search.const import RULESET_FORMATS
+from semgrep_search.delta import snapshot_file, store_snapshot
+from semgrep_search.facets import apply_facets, compute_index
+from semgrep_search.inspection import count_rules
+from semgrep_search.runconfig import RunConfig
+from semgrep_search.search import filter_rules
+from semgrep_search.utils import atomic_write, get_commit, hash_rule, logger, measure_time, write_ruleset
+
+if TYPE_CHECKING:
+    import argparse
+    from tinydb import TinyDB
+
+PACKAGE_DIR = Path(__file__).parent
+
+
+def parse_codes(codes: list[str]) -> dict[str, RunConfig]:
+    configs = {}
+    for code in codes:
+        try:
+            config = RunConfig.from_code(code)
+        except ValueError as e:
+            logger.error(f'Invalid run configuration {code}: {e}')
+            sys.exit(1)
+        # Rulesets are looked up by the normalized code
+        configs[config.to_code()] = config
+    return configs
+
+
+def generate_rulesets(db: TinyDB, cache: DerivedCache, configs: dict[str, RunConfig]) -> None:
+    rules = db.table('rules')
+    fragments = {ruleset_format: load_fragments(ruleset_format) for ruleset_format in RULESET_FORMATS}
+    for code, config in configs.items():
+        apply_facets(config.filter_config, db)
+        result = filter_rules(rules, config.filter_config)
+        for ruleset_format in RULESET_FORMATS:
+            with atomic_write(cache.ruleset(code, ruleset_format)) as stream:
+                write_ruleset(result, stream, fragments[ruleset_format], ruleset_format)
+        logger.info(f'Generated rulesets for {code} with {len(result)} rules')
+
+
+def verify(db: TinyDB, cache: DerivedCache, codes: list[str]) -> list[str]:
+    """
+    Checks that everything a run needs is available locally. Returns the list of missing artifacts.
+    """
+    missing = []
+    if not snapshot_file(get_commit(db)).is_file():
+        missing.append('rule snapshot')
+    if not cache.path('stats.json').is_file():
+        missing.append('statistics')
+    if not cache.path('facets.json').is_file():
+        missing.append('rule metadata')
+
+    for ruleset_format in RULESET_FORMATS:
+        fragments = load_fragments(ruleset_format)
+        if any(hash_rule(rule) not in fragments for rule in db.table('rules')):
+            missing.append(f'pre-rendered rules ({ruleset_format})')
+
+        missing.extend(f'ruleset {code} ({ruleset_format})' for code in codes
+                       if not cache.ruleset(code, ruleset_format).is_file())
+
+    for module in PACKAGE_DIR.glob('*.py'):
+        if not Path(importlib.util.cache_from_source(str(module))).is_file():
+            missing.append(f'bytecode of {module.name}')
+    return missing
+
+
+def warm(args: argparse.Namespace, db: TinyDB) -> None:
+    cache = DerivedCache.for_db(db)
+    if cache.directory is None:
+        logger.error('Database does not specify a commit, unable to store derived artifacts')
+        sys.exit(1)
+
+    configs = parse_codes(args.codes)
+
+    with measure_time('Stored rule snapshot in %s', logging.DEBUG):
+        store_snapshot(db)
+
+    with measure_time('Gathered statistics in %s', logging.DEBUG):
+        cache.store('stats.json', count_rules(db))
+
+    cache.store('facets.json', compute_index(db))
+
+    for ruleset_format in RULESET_FORMATS:
+        with measure_time(f'Pre-rendered rules as {ruleset_format} in %s', logging.DEBUG):
+            rendered, total = update_fragments(db, ruleset_format)
+        logger.info(f'Rendered {rendered} of {total} rules as {ruleset_format}')
+
+    with measure_time('Generated rulesets in %s', logging.DEBUG):
+        generate_rulesets(db, cache, configs)
+
+    with measure_time('Compiled package in %s', logging.DEBUG):
+        compileall.compile_dir(PACKAGE_DIR, quiet=1)
+
+    missing = verify(db, cache, list(configs))
+    if missing:
+        for artifact in missing:
+            logger.error(f'Missing {artifact}')
+        sys.exit(1)
+    logger.info(f'All artifacts for database {get_commit(db)} are available, runs will not need to recompute them')
@@ -0,0 +1,340 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Watches the target after the initial scan of run --watch and rescans only the files that changed, using the ruleset
+of the initial scan. The findings of the changed files replace theirs in the JSON and SARIF outputs.
+
+Changes are reported by inotify on Linux. Everywhere else (or if inotify is not available), the manifest of the target
+is refreshed periodically instead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, Optional, TYPE_CHECKING
+
+from semgrep_search.manifest import refresh_manifest
+from semgrep_search.metrics import metrics
+from semgrep_search.results import RuleIndex, count_severities, replace_paths
+from semgrep_search.semgrep import run_semgrep
+from semgrep_search.targets import IGNORED_DIRECTORIES, join
+from semgrep_search.utils import logger
+
+if TYPE_CHECKING:
+    from tinydb import TinyDB
+    from semgrep_search.runconfig import RunConfig
+
+# Seconds without further changes before the changed files are rescanned
+DEBOUNCE = 0.1
+# Seconds after which the changes of a burst are rescanned even if it did not end yet
+MAX_DELAY = 1.0
+# Seconds between refreshes of the manifest if inotify is not available
+POLL_INTERVAL = 1.0
+# Rescan the whole target instead of passing this many files to semgrep, e.g. after switching branches
+MAX_CHANGED_FILES = 1000
+
+# Files created by editors while saving, which semgrep would scan if they were passed explicitly
+TEMPORARY_FILES = re.compile(r'(^|/)(\.#[^/]*|[^/]*(~|\.sw[px]|\.tmp))$')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# Files are only rescanned once they were closed, not for every write
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+
+class Watcher(ABC):
+    """
+    Reports the paths (relative to the target) of the files that changed. None stands for an unknown set of changes.
+    """
+
+    @abstractmethod
+    async def wait(self, timeout: Optional[float] = None) -> Optional[set[str]]:
+        """Waits up to timeout seconds for changes, returns an empty set if nothing changed"""
+
+    def close(self) -> None:
+        pass
+
+    async def changes(self) -> Optional[set[str]]:
+        """Waits for the next burst of changes to end"""
+        changed = await self.wait()
+        deadline = time.monotonic() + MAX_DELAY
+        while changed is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more = await self.wait(min(DEBOUNCE, remaining))
+            if not more:
+                if more is None:
+                    return None
+                break
+            changed |= more
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watches every directory of the target with inotify, which is only available on Linux
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories: dict[int, str] = {}
+        self._files: set[str] = set()
+        self._ready = asyncio.Event()
+        try:
+            self._watch_tree('')
+        except OSError:
+            self.close()
+            raise
+        asyncio.get_running_loop().add_reader(self._fd, self._ready.set)
+
+    def close(self) -> None:
+        if self._fd < 0:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._fd)
+        except RuntimeError:
+            pass
+        os.close(self._fd)
+        self._fd = -1
+
+    def _watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(self.root / directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f'Unable to watch {self.root / directory}: {os.strerror(error)}')
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory: str) -> set[str]:
+        """Watches the directory and everything within, returns the files within"""
+        files = set()
+        for current, dirs, names in os.walk(self.root / directory):
+            dirs[:] = [name for name in dirs if name not in IGNORED_DIRECTORIES]
+            path = Path(current).relative_to(self.root).as_posix()
+            path = '' if path == '.' else path
+            try:
+                self._watch(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # Out of watches (fs.inotify.max_user_watches), nothing else will work either
+                    raise
+                logger.debug(str(e))
+                continue
+            files.update(join(path, name) for name in names)
+        self._files |= files
+        return files
+
+    def _forget_tree(self, directory: str) -> set[str]:
+        """Returns the files that were within a directory that was removed"""
+        prefix = f'{directory}/'
+        files = {file for file in self._files if file.startswith(prefix)}
+        self._files -= files
+        return files
+
+    def _read(self) -> Optional[set[str]]:
+        changed: Optional[set[str]] = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0'))
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changed = None
+                    continue
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None or changed is None:
+                    continue
+                path = join(directory, name)
+                if not mask & IN_ISDIR:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._files.discard(path)
+                    else:
+                        self._files.add(path)
+                    changed.add(path)
+                elif name in IGNORED_DIRECTORIES:
+                    continue
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        changed |= self._watch_tree(path)
+                    except OSError as e:
+                        logger.warning(f'Unable to watch {path}, its changes are missed: {e}')
+                else:
+                    changed |= self._forget_tree(path)
+        if changed is None:
+            logger.warning('Missed changes of the target, rescanning all of it')
+            self._files.clear()
+            self._watch_tree('')
+        return changed
+
+    async def wait(self, timeout: Optional[float] = None) -> Optional[set[str]]:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+        self._ready.clear()
+        return self._read()
+
+
+class PollingWatcher(Watcher):
+    """
+    Refreshes the manifest of the target, which only reads the files whose size or modification time changed
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._next = time.monotonic()
+        refresh_manifest(root)
+
+    async def wait(self, timeout: Optional[float] = None) -> Optional[set[str]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if deadline is not None and self._next > deadline:
+                await asyncio.sleep(max(deadline - now, 0))
+                return set()
+            await asyncio.sleep(max(self._next - now, 0))
+            self._next = time.monotonic() + POLL_INTERVAL
+            files = await asyncio.get_running_loop().run_in_executor(None, refresh_manifest, self.root)
+            changed = {*files.changes.added, *files.changes.modified, *files.changes.removed}
+            if changed:
+                return changed
+
+
+def open_watcher(root: Path) -> Watcher:
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logger.warning(f'Unable to watch the target using inotify ({e}), polling for changes instead')
+    return PollingWatcher(root)
+
+
+def ignored_paths(run: RunConfig) -> Callable[[str], bool]:
+    """Changes to the outputs (and their temporary files) and to temporary files of editors are ignored"""
+    root = run.target.resolve()
+    outputs = set()
+    prefixes = []
+    for file in run.output_files().values():
+        try:
+            path = file.resolve().relative_to(root).as_posix()
+        except ValueError:
+            continue
+        outputs.add(path)
+        prefixes.append(join(path.rpartition('/')[0], f'.{file.name}.'))
+    temporary = tuple(prefixes)
+
+    def ignored(path: str) -> bool:
+        if path in outputs or TEMPORARY_FILES.search(path) is not None:
+            return True
+        return bool(temporary) and path.startswith(temporary)
+    return ignored
+
+
+def enrich(index: RuleIndex, output_format: str, file: Path) -> None:
+    (index.enrich_json if output_format == 'json' else index.enrich_sarif)(file)
+
+
+async def rescan(run: RunConfig, paths: Optional[set[str]], index: Optional[RuleIndex]) -> None:
+    """Rescans the changed files (all of the target if None) and updates their findings in the outputs"""
+    outputs = {output_format: file for output_format, file in run.output_files().items() if output_format != 'text'}
+    started = time.perf_counter()
+    if paths is None:
+        await run_semgrep(run)
+        if index is not None:
+            for output_format, file in outputs.items():
+                if file.is_file():
+                    enrich(index, output_format, file)
+        logger.info(f'Rescanned the target in {time.perf_counter() - started:.2f}s')
+        return
+
+    existing = sorted(path for path in paths if (run.target / path).is_file())
+    findings = 0
+    with tempfile.TemporaryDirectory(prefix='semgrep-search-watch-') as tmp:
+        base = Path(tmp) / 'changes'
+        if existing:
+            await run_semgrep(run, targets=existing, output=base)
+        for output_format, destination in outputs.items():
+            update: Optional[Path] = run.output_files(base)[output_format]
+            if not existing:
+                update = None
+            elif not update.is_file():
+                logger.warning(f'semgrep did not create a {output_format} output, keeping the previous findings')
+                continue
+            else:
+                if index is not None:
+                    enrich(index, output_format, update)
+                findings = sum(count_severities(update, output_format).values())
+            replace_paths(output_format, destination, update, paths)
+    metrics.inc('sgs_watch_rescans_total', 'Number of rescans of changed files')
+    removed = len(paths) - len(existing)
+    logger.info(f'Rescanned {len(existing)} changed files in {time.perf_counter() - started:.2f}s: {findings} findings'
+                + (f', {removed} files were removed' if removed else ''))
+
+
+async def watch(run: RunConfig, db: TinyDB) -> None:
+    """Rescans the target whenever files changed, until interrupted"""
+    if 'text' in run.output_files():
+        logger.warning('Text outputs are not updated while watching, they only contain the findings of the first scan')
+    index = RuleIndex.from_db(db) if run.enrich else None
+    ignored = ignored_paths(run)
+    watcher = open_watcher(run.target.resolve())
+    logger.info(f'Watching {run.target} for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            changed = await watcher.changes()
+            if changed is not None:
+                changed = {path for path in changed if not ignored(path)}
+                if not changed:
+                    continue
+                logger.debug(f'Changed: {", ".join(sorted(changed))}')
+                if len(changed) > MAX_CHANGED_FILES:
+                    changed = None
+            await rescan(run, changed, index)
+    finally:
+        watcher.close()
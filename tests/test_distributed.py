@@ -0,0 +1,156 @@
+#      Semgrep-Search
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Runs a distributed scan with several worker processes on this machine against a stub semgrep. The first worker is
+killed while it runs its job, which has to be retried by the other workers once its lease expired.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from semgrep_search.distributed import DirectoryQueue, Job, Session, coordinate
+from semgrep_search.metrics import metrics
+from semgrep_search.runconfig import RunConfig
+from semgrep_search.sharding import plan_shards
+
+STUB = r'''#!{python}
+import json, os, sys, time
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('0.0.0-stub')
+    sys.exit(0)
+hang = os.environ.get('STUB_HANG')
+if hang:
+    # Tells the test that the job is running, then never completes it
+    open(hang, 'w').close()
+    time.sleep(600)
+
+options = {{args[i]: args[i + 1] for i in range(len(args) - 1) if args[i].startswith('--')}}
+targets = [arg for i, arg in enumerate(args) if not arg.startswith('-') and not args[i - 1].startswith('--')] or ['.']
+files = []
+for target in targets:
+    if os.path.isfile(target):
+        files.append(target)
+    for root, _, names in os.walk(target):
+        files.extend(os.path.normpath(os.path.join(root, name)) for name in names)
+results = [{{'check_id': 'stub.rule', 'path': path, 'start': {{'line': 1, 'col': 1}}, 'end': {{'line': 1, 'col': 2}},
+            'extra': {{'message': 'm', 'severity': 'ERROR', 'lines': 'x', 'metadata': {{}}}}}} for path in files]
+with open(options['--json-output'], 'w') as stream:
+    json.dump({{'results': results, 'errors': [], 'paths': {{'scanned': files}}, 'version': '0.0.0-stub'}}, stream)
+'''
+
+LEASE = 1.0
+TIMEOUT = 60
+
+
+def start_worker(queue: Path, stub: Path, name: str, home: Path, hang: Optional[Path] = None) -> subprocess.Popen:
+    env = {**os.environ, 'HOME': str(home)}
+    if hang is not None:
+        env['STUB_HANG'] = str(hang)
+    # In its own process group, so killing it kills its semgrep as well
+    return subprocess.Popen([sys.executable, '-m', 'semgrep_search', 'worker', str(queue), '--binary', str(stub),
+                             '--id', name], env=env, start_new_session=True, cwd=Path(__file__).parent.parent)
+
+
+def retried() -> float:
+    return sum(value for _, value in metrics.samples('sgs_jobs_retried_total'))
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Requires process groups')
+def test_killed_worker_is_retried(tmp_path: Path) -> None:
+    stub = tmp_path / 'semgrep'
+    stub.write_text(STUB.format(python=sys.executable))
+    stub.chmod(0o755)
+    target = tmp_path / 'target'
+    files = {f'dir{i}/file{j}.py' for i in range(4) for j in range(3)}
+    for file in files:
+        (target / file).parent.mkdir(parents=True, exist_ok=True)
+        (target / file).write_text('x = 1\n')
+    ruleset = tmp_path / 'rules.yaml'
+    ruleset.write_text('rules: []\n')
+    queue = tmp_path / 'queue'
+    home = tmp_path / 'home'
+    hang = tmp_path / 'hanging'
+
+    run = RunConfig.from_rules_file(ruleset, ['export_json'])
+    run.distribute = str(queue)
+    run.lease = LEASE
+    run.rule_shards = 1
+    run.target = target
+    run.output = tmp_path / 'out' / 'merged'
+    run.output.parent.mkdir()
+    shards = plan_shards(target, 4, False)
+    before = retried()
+
+    workers = [start_worker(queue, stub, 'killed', home, hang)]
+
+    async def scenario() -> int:
+        coordinator = asyncio.create_task(coordinate(run, None, shards))
+        deadline = time.monotonic() + TIMEOUT
+        while not hang.exists():
+            assert time.monotonic() < deadline, 'The first worker never started its job'
+            await asyncio.sleep(0.1)
+        os.killpg(workers[0].pid, signal.SIGKILL)
+        workers.extend(start_worker(queue, stub, f'worker-{i}', home) for i in range(2))
+        return await asyncio.wait_for(coordinator, TIMEOUT)
+
+    try:
+        rc = asyncio.run(scenario())
+        for process in workers[1:]:
+            assert process.wait(TIMEOUT) == 0
+    finally:
+        for process in workers:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+    assert rc == 0
+    # The job of the killed worker was retried exactly once, no job was given up on
+    assert retried() - before == 1
+    assert not list((queue / 'failed').iterdir())
+    assert len(list((queue / 'done').iterdir())) == len(shards)
+    # Every file was scanned by exactly one of the jobs
+    with run.output_files()['json'].open('r', encoding='utf-8') as stream:
+        merged = json.load(stream)
+    paths = [result['path'] for result in merged['results']]
+    assert sorted(paths) == sorted(files)
+    assert sorted(merged['paths']['scanned']) == sorted(files)
+
+
+def test_open_session_is_not_replaced(tmp_path: Path) -> None:
+    ruleset = tmp_path / 'rules.yaml'
+    ruleset.write_text('rules: []\n')
+    queue = DirectoryQueue(tmp_path / 'queue')
+    session = Session('first', str(tmp_path), [], 1, LEASE)
+    queue.open_session(session, {'rules.yaml': ruleset}, [Job('first-0000', 'rules.yaml')])
+    with pytest.raises(ValueError, match='still open'):
+        queue.open_session(Session('second', str(tmp_path), [], 0, LEASE), {'rules.yaml': ruleset}, [])
+    queue.close_session()
+    queue.open_session(Session('second', str(tmp_path), [], 0, LEASE), {'rules.yaml': ruleset}, [])
+    assert queue.session().id == 'second'